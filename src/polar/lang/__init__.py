@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from collections.abc import Mapping, MutableMapping
 from typing import Union, List, Optional
 from frozendict import frozendict
 
@@ -11,10 +12,72 @@ class PolarInternalError(RuntimeError):
     pass
 
 
+class PolarParserError(PolarInternalError):
+    pass
+
+
 class Context(frozendict):
     pass
 
 
+_DELETED = object()
+
+
+class OverlayContext(MutableMapping):
+    """
+    Copy-on-write context of request over shared session context.
+    Writes and deletes go to per-request overlay, so shared context is never
+    changed and overlay is the diff to store. Values aren't copied: nested
+    values must be replaced, not changed in place.
+    """
+
+    def __init__(self, base: Mapping):
+        self._base = base
+        self._overlay = {}
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            value = self._overlay[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._base[key]
+
+    def __setitem__(self, key, value):
+        if key in self._base and self._base[key] == value:
+            # Same as shared value, nothing to store
+            self._overlay.pop(key, None)
+        else:
+            self._overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self._overlay[key] = _DELETED
+        else:
+            del self._overlay[key]
+
+    def __iter__(self):
+        for key in self._base:
+            if self._overlay.get(key) is not _DELETED:
+                yield key
+        for key in self._overlay:
+            if key not in self._base and self._overlay[key] is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    @property
+    def changes(self) -> dict:
+        return {k: v for k, v in self._overlay.items() if v is not _DELETED}
+
+    @property
+    def deleted(self) -> List[str]:
+        return [k for k, v in self._overlay.items() if v is _DELETED]
+
+
 class Event:
     pass
 
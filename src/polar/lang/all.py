@@ -84,8 +84,8 @@ class Set(AstNode):
         self.value = value
 
     async def eval(self, event: Event, context: Context, inter: Interactivity) -> Optional[EvalResult]:
+        # Changed context is written back to session after request
         context[self.name] = self.value
-        await context.commit()
 
         return None
 
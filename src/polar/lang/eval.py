@@ -1,7 +1,17 @@
-from typing import List
+import asyncio
+import heapq
+import logging
+from concurrent.futures import Executor as PoolExecutor
+from typing import List, Optional, Tuple
 
-from polar.lang import Event, Context, Interactivity, MatchResult, ListN
+from polar.lang import Event, Context, Interactivity, MatchResult, ListN, UserMessage, OverlayContext
 from polar.lang.all import Flow
+from polar.lang.matcher import RuleMatcher
+from polar.lang.regex_rule import RegexRule
+from polar.lang.suggest import SuggestIndex
+
+
+logger = logging.getLogger(__name__)
 
 
 class Rule:
@@ -15,12 +25,53 @@ class Rule:
 class Bot:
     def __init__(self):
         self.rules: List[Rule] = []
+        self._matcher: Optional[RuleMatcher] = None
+        self._suggest_index: Optional[SuggestIndex] = None
+        # Template id -> (template version, rules compiled from it)
+        self._template_rules = {}
 
     def add_rule(self, rule):
         self.rules.append(rule)
+        self._reset_indexes()
 
     def add_rules(self, rules):
         self.rules.extend(rules)
+        self._reset_indexes()
+
+    def add_template_rules(self, template_id, version, rules):
+        """
+        Add rules compiled from template. Only successfully compiled
+        templates should be added, added rules are reused for same version.
+        """
+        self._template_rules[template_id] = (version, rules)
+        self.add_rules(rules)
+
+    def get_template_rules(self, template_id, version) -> Optional[List[Rule]]:
+        """
+        Rules compiled from template if it has same version, for reusing
+        in next bot. Templates without version are never reused.
+        """
+        compiled = self._template_rules.get(template_id)
+        if version is None or compiled is None or compiled[0] != version:
+            return None
+        return compiled[1]
+
+    @property
+    def matcher(self) -> RuleMatcher:
+        # Built once on first request and dropped on rules change
+        if self._matcher is None:
+            self._matcher = RuleMatcher(self.rules)
+        return self._matcher
+
+    @property
+    def suggest_index(self) -> SuggestIndex:
+        if self._suggest_index is None:
+            self._suggest_index = SuggestIndex(self.rules)
+        return self._suggest_index
+
+    def _reset_indexes(self):
+        self._matcher = None
+        self._suggest_index = None
 
 
 class ExecutorState:
@@ -28,18 +79,72 @@ class ExecutorState:
         self.sorted_results = sorted_results
 
 
+def get_match_weight(match_result: MatchResult):
+    return sum(m.weight * abs(m.end - m.start) for m in match_result.ranges)
+
+
+def match_regex_conditions(conditions: List[List[RegexRule]], text: str) -> List[List[MatchResult]]:
+    """
+    Matches of every regex-only condition, same as evaluating condition
+    flow. Runs outside event loop, so touches nothing but rules and text.
+    """
+    results = []
+    for commands in conditions:
+        matches = (command.match(text) for command in commands)
+        results.append([match for match in matches if match is not None])
+    return results
+
+
 class Executor:
-    @classmethod
-    async def execute_event(cls, event: Event, bot: Bot, context: Context, inter: Interactivity) -> ExecutorState:
-        matched_results = await cls._test_rules(event, bot, context)
+    # Rules per best-first step when matching is offloaded to pool
+    OFFLOAD_BATCH_SIZE = 64
 
-        if not matched_results:
-            return None
+    def __init__(self, *, best_first: bool=False, top_k: Optional[int]=None, debug: bool=False,
+                 concurrency: Optional[int]=None, condition_timeout: Optional[float]=None,
+                 match_executor: Optional[PoolExecutor]=None):
+        """
+        :param best_first: evaluate rules in order of weight upper bound and
+            stop when no rule left can get in top results
+        :param top_k: keep only k best matches in state, all if None.
+            Best-first keeps only best match by default
+        :param debug: evaluate all rules and keep full ranking in state
+        :param concurrency: evaluate up to this number of rule conditions
+            concurrently, one by one if None
+        :param condition_timeout: seconds for single condition evaluation,
+            condition not finished in time doesn't match
+        :param match_executor: thread or process pool for matching regex-only
+            conditions outside of event loop. Other conditions and rule flow
+            are still evaluated in event loop
+        """
+        self._best_first = best_first
+        self._top_k = top_k
+        self._debug = debug
+        self._concurrency = concurrency
+        self._condition_timeout = condition_timeout
+        self._match_executor = match_executor
 
-        def get_match_weight(match_result: MatchResult):
-            return sum(m.weight * abs(m.end - m.start) for m in match_result.ranges)
+    async def execute_event(self, event: Event, bot: Bot, context: Context, inter: Interactivity) -> ExecutorState:
+        sorted_results = await self.rank(event, bot, context)
+        return await self.execute_ranked(sorted_results, event, bot, context, inter)
 
-        sorted_results = sorted(matched_results, key=lambda res: -get_match_weight(res[1]))
+    async def rank(self, event: Event, bot: Bot, context: Context) -> List[Tuple[int, MatchResult]]:
+        """
+        Matching phase: (rule index, match) pairs by descending weight
+        """
+        if self._debug:
+            return self._rank(await self._test_rules(event, bot, context), None)
+        elif self._best_first:
+            return await self._test_rules_best_first(event, bot, context, self._top_k or 1)
+        else:
+            return self._rank(await self._test_rules(event, bot, context), self._top_k)
+
+    async def execute_ranked(self, sorted_results: List[Tuple[int, MatchResult]], event: Event, bot: Bot,
+                             context: Context, inter: Interactivity) -> Optional[ExecutorState]:
+        """
+        Evaluate flow of best ranked rule
+        """
+        if not sorted_results:
+            return None
 
         # TODO: Peek suitable results to evaluate by range. Currently first best
         best_response = sorted_results[0]
@@ -54,27 +159,133 @@ class Executor:
             sorted_results=sorted_results,
         )
 
-    @classmethod
-    async def _test_rules(cls, event: Event, bot: Bot, context: Context):
+    @staticmethod
+    def _rank(matched_results, top_k: Optional[int]):
+        """
+        Matches by descending weight, stable by rule order
+        """
+        key = lambda res: -get_match_weight(res[1])
+        if top_k is None:
+            return sorted(matched_results, key=key)
+        # Same as sorted()[:top_k] without sorting all matches
+        return heapq.nsmallest(top_k, matched_results, key=key)
+
+    async def _test_rules(self, event: Event, bot: Bot, context: Context):
         matched_results = []
 
-        dummy_inter = Interactivity()
+        rule_idxs = bot.matcher.candidates(event)
+        for rule_idx, matches in zip(rule_idxs, await self._test_rules_batch(rule_idxs, event, bot, context)):
+            matched_results.extend((rule_idx, match) for match in matches)
 
-        for rule_idx, rule in enumerate(bot.rules):
-            resp = await rule.condition.eval(event, context, dummy_inter)
-            if resp is None or resp.value is None:
-                continue
+        return matched_results
 
-            if isinstance(resp.value, ListN) and not resp.value.value:
-                continue
+    async def _test_rules_best_first(self, event: Event, bot: Bot, context: Context, top_k: int):
+        # Min-heap of k best matches, worst on top. Among equal weights
+        # earlier rule and earlier match in rule are better
+        top = []
 
-            # Merge MatchResult(s) and store in all results
+        ranked = bot.matcher.ranked_candidates(event)
+        batch_size = self._concurrency or (self.OFFLOAD_BATCH_SIZE if self._match_executor else 1)
+        for start in range(0, len(ranked), batch_size):
+            # Rules are ordered by bound, so no rule left can get in top.
+            # Equal weight still can get in by lower index
+            batch = [rule_idx for rule_idx in ranked[start:start + batch_size]
+                     if len(top) < top_k or bot.matcher.weight_bound(rule_idx, event) >= top[0][0]]
+            if not batch:
+                break
 
-            if isinstance(resp.value, MatchResult):
-                matched_results.append((rule_idx, resp))
-            elif isinstance(resp.value, ListN) and all(isinstance(m, MatchResult) for m in resp.value.value):
-                matched_results.extend([(rule_idx, r) for r in resp.value.value])
-            else:
-                raise RuntimeError("Response %s is not MatchResult or List[MatchResult]" % resp.value)
+            # Batch results are merged in rank order, same as one by one
+            for rule_idx, matches in zip(batch, await self._test_rules_batch(batch, event, bot, context)):
+                for match_idx, match in enumerate(matches):
+                    item = (get_match_weight(match), -rule_idx, -match_idx, match)
+                    if len(top) < top_k:
+                        heapq.heappush(top, item)
+                    elif item[:3] > top[0][:3]:
+                        heapq.heapreplace(top, item)
 
-        return matched_results
+        top.sort(key=lambda item: item[:3], reverse=True)
+        return [(-rule_idx, match) for _, rule_idx, _, match in top]
+
+    async def _test_rules_batch(self, rule_idxs: List[int], event: Event, bot: Bot, context: Context) \
+            -> List[List[MatchResult]]:
+        """
+        Matches of every rule in same order as rules
+        """
+        if self._match_executor is not None and isinstance(event, UserMessage):
+            return await self._test_rules_offloaded(rule_idxs, event, bot, context)
+
+        return await self._test_rules_inline(rule_idxs, event, bot, context)
+
+    async def _test_rules_offloaded(self, rule_idxs: List[int], event: UserMessage, bot: Bot, context: Context) \
+            -> List[List[MatchResult]]:
+        offloaded, inline = [], []
+        for idx, rule_idx in enumerate(rule_idxs):
+            (offloaded if bot.matcher.regex_condition(rule_idx) is not None else inline).append(idx)
+
+        results = [None] * len(rule_idxs)
+
+        if offloaded:
+            # Only compiled regexes and text are passed, so process pool
+            # doesn't need bot or context
+            conditions = [bot.matcher.regex_condition(rule_idxs[idx]) for idx in offloaded]
+            loop = asyncio.get_event_loop()
+            matches = await loop.run_in_executor(self._match_executor, match_regex_conditions,
+                                                 conditions, event.text)
+            for idx, rule_matches in zip(offloaded, matches):
+                results[idx] = rule_matches
+
+        if inline:
+            matches = await self._test_rules_inline([rule_idxs[idx] for idx in inline], event, bot, context)
+            for idx, rule_matches in zip(inline, matches):
+                results[idx] = rule_matches
+
+        return results
+
+    async def _test_rules_inline(self, rule_idxs: List[int], event: Event, bot: Bot, context: Context) \
+            -> List[List[MatchResult]]:
+        if not self._concurrency or len(rule_idxs) < 2:
+            return [await self._test_rule_timed(bot.rules[rule_idx], event, context) for rule_idx in rule_idxs]
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+        # Every condition writes to own overlay, so concurrent conditions
+        # don't see each other changes
+        overlays = [OverlayContext(context) for _ in rule_idxs]
+
+        async def test(rule_idx, overlay):
+            async with semaphore:
+                return await self._test_rule_timed(bot.rules[rule_idx], event, overlay)
+
+        results = await asyncio.gather(*(test(rule_idx, overlay) for rule_idx, overlay in zip(rule_idxs, overlays)))
+
+        # Changes are applied in rule order, later rule wins
+        for overlay in overlays:
+            for key in overlay.deleted:
+                context.pop(key, None)
+            for key, value in overlay.changes.items():
+                context[key] = value
+
+        return results
+
+    async def _test_rule_timed(self, rule: Rule, event: Event, context: Context) -> List[MatchResult]:
+        if self._condition_timeout is None:
+            return await self._test_rule(rule, event, context)
+
+        try:
+            return await asyncio.wait_for(self._test_rule(rule, event, context), self._condition_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Condition of rule %s timed out after %ss", rule.name, self._condition_timeout)
+            return []
+
+    async def _test_rule(self, rule: Rule, event: Event, context: Context) -> List[MatchResult]:
+        resp = await rule.condition.eval(event, context, Interactivity())
+        if resp is None or resp.value is None:
+            return []
+
+        # Merge MatchResult(s) and store in all results
+
+        if isinstance(resp.value, MatchResult):
+            return [resp.value]
+        elif isinstance(resp.value, ListN) and all(isinstance(m, MatchResult) for m in resp.value.value):
+            return resp.value.value
+        else:
+            raise RuntimeError("Response %s is not MatchResult or List[MatchResult]" % resp.value)
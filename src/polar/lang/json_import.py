@@ -1,13 +1,16 @@
+import asyncio
 import json
 import os
 import subprocess
 
 import sys
 from functools import wraps
+from typing import Optional, List, Tuple, Dict, AsyncIterable
 
 from polar.lang import TermNode, RuleNode, AstNode
 from polar.lang.all import Flow, SimpleResponse, CallNode
 from polar.lang.eval import Bot, Rule
+from polar.lang.parser_pool import get_parser_pool
 from polar.lang.regex_rule import RegexRule
 
 _node_creators = {}
@@ -88,7 +91,7 @@ def load(js: dict) -> AstNode:
     return _load_node(js)
 
 
-def load_bot_rule(bot: Bot, js: dict):
+def load_rule(js: dict, name=None) -> Rule:
     rule_all_flow = load(js)
 
     if not isinstance(rule_all_flow, Flow):
@@ -96,7 +99,7 @@ def load_bot_rule(bot: Bot, js: dict):
 
     simple_responses = []
 
-    rule = Rule()
+    rule = Rule(name=name)
     for command in rule_all_flow.commands:
         if isinstance(command, RuleNode):
             rule.condition.commands.append(command)
@@ -105,27 +108,186 @@ def load_bot_rule(bot: Bot, js: dict):
 
     rule.flow.commands.append(SimpleResponse(simple_responses))
 
-    bot.add_rule(rule)
+    return rule
 
 
-def load_bot_rule_content(bot: Bot, content: str):
+def load_bot_rule(bot: Bot, js: dict, name=None):
+    bot.add_rule(load_rule(js, name))
+
+
+def _parser_executable() -> str:
     POLAR_PARSER_EXECUTABLE = os.getenv("POLAR_PARSER_EXECUTABLE")
     if not POLAR_PARSER_EXECUTABLE:
         raise RuntimeError("No polar-parser given!")
+    return POLAR_PARSER_EXECUTABLE
+
 
-    polar_parser_call = subprocess.Popen([POLAR_PARSER_EXECUTABLE],
+def parse_content(content: str) -> Optional[dict]:
+    """
+    Parses template content with polar-parser. None if parser returned nothing.
+    Uses shared parser pool if it's configured.
+    """
+    pool = get_parser_pool()
+    if pool is not None:
+        return pool.parse(content)
+
+    polar_parser_call = subprocess.Popen([_parser_executable()],
                                          stderr=subprocess.PIPE,
                                          stdin=subprocess.PIPE,
                            stdout=subprocess.PIPE)
     stdout, stderr = polar_parser_call.communicate(content.encode())
 
+    return _load_content_output(stdout)
+
+
+async def parse_content_async(content: str) -> Optional[dict]:
+    """
+    Same as `parse_content` without blocking event loop
+    """
+    pool = get_parser_pool()
+    if pool is not None:
+        return await asyncio.get_event_loop().run_in_executor(None, pool.parse, content)
+
+    polar_parser_call = await asyncio.create_subprocess_exec(_parser_executable(),
+                                                             stderr=subprocess.PIPE,
+                                                             stdin=subprocess.PIPE,
+                                                             stdout=subprocess.PIPE)
+    stdout, stderr = await polar_parser_call.communicate(content.encode())
+
+    return _load_content_output(stdout)
+
+
+def _load_content_output(stdout: bytes) -> Optional[dict]:
     data = stdout.decode()
     if not data:
-        return "Empty data from polar-server"
+        return None
 
-    js = json.loads(data)
+    return json.loads(data)
+
+
+def parse_batch(items: List[Tuple[str, str]]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    """
+    Parses many template contents in one `polar-parser --batch` run.
+    Input is newline-delimited `{"id", "content"}` records, output records are
+    `{"id", "result"}` or `{"id", "error"}`.
+    :param items: (id, content) pairs
+    :return: parsed json and error text by id
+    """
+    polar_parser_call = subprocess.Popen([_parser_executable(), "--batch"],
+                                         stderr=subprocess.PIPE,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+    stdout, stderr = polar_parser_call.communicate(_batch_input(items))
+
+    return _load_batch_output(items, stdout, stderr)
+
+
+async def parse_batch_async(items: List[Tuple[str, str]]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    """
+    Same as `parse_batch` without blocking event loop
+    """
+    polar_parser_call = await asyncio.create_subprocess_exec(_parser_executable(), "--batch",
+                                                             stderr=subprocess.PIPE,
+                                                             stdin=subprocess.PIPE,
+                                                             stdout=subprocess.PIPE)
+    stdout, stderr = await polar_parser_call.communicate(_batch_input(items))
+
+    return _load_batch_output(items, stdout, stderr)
+
+
+async def parse_batch_stream(items: AsyncIterable[Tuple[str, str]]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+    """
+    Same as `parse_batch_async` with items coming while polar-parser runs.
+    One polar-parser process gets items as they come, none is started
+    without items.
+    """
+    items = items.__aiter__()
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        return {}, {}
+
+    polar_parser_call = await asyncio.create_subprocess_exec(_parser_executable(), "--batch",
+                                                             stderr=subprocess.PIPE,
+                                                             stdin=subprocess.PIPE,
+                                                             stdout=subprocess.PIPE)
+    # Only ids are kept, content is dropped once sent
+    sent = []
+
+    async def write():
+        item_id, content = first
+        broken = False
+        try:
+            while True:
+                sent.append((item_id, None))
+                if not broken:
+                    try:
+                        polar_parser_call.stdin.write(_batch_input([(item_id, content)]))
+                        await polar_parser_call.stdin.drain()
+                    except (BrokenPipeError, ConnectionResetError):
+                        # Items are still taken, rest of them get error of
+                        # exited polar-parser
+                        broken = True
+                try:
+                    item_id, content = await items.__anext__()
+                except StopAsyncIteration:
+                    break
+        finally:
+            polar_parser_call.stdin.close()
+
+    try:
+        stdout, stderr, _ = await asyncio.gather(polar_parser_call.stdout.read(),
+                                                 polar_parser_call.stderr.read(),
+                                                 write())
+    except BaseException:
+        if polar_parser_call.returncode is None:
+            polar_parser_call.kill()
+        raise
+    finally:
+        await polar_parser_call.wait()
+
+    return _load_batch_output(sent, stdout, stderr)
+
+
+def _batch_input(items) -> bytes:
+    return "".join(json.dumps({"id": item_id, "content": content}) + "\n"
+                   for item_id, content in items).encode()
+
+
+def _load_batch_output(items, stdout: bytes, stderr: bytes):
+    results, errors = {}, {}
+    malformed = None
+    for line in stdout.decode().splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            record_id = record["id"]
+        except (ValueError, KeyError, TypeError) as e:
+            # Item of broken line is unknown, it ends up without result below
+            malformed = "Malformed polar-parser output %r: %s" % (line[:100], e)
+            continue
+
+        if record.get("error") is not None:
+            errors[record_id] = record["error"]
+        elif record.get("result") is None:
+            errors[record_id] = "Empty data from polar-server"
+        else:
+            results[record_id] = record["result"]
+
+    for item_id, _ in items:
+        if item_id not in results and item_id not in errors:
+            errors[item_id] = malformed or stderr.decode().strip() or "No result from polar-parser"
+
+    return results, errors
+
+
+def load_bot_rule_content(bot: Bot, content: str, name=None):
+    js = parse_content(content)
+    if js is None:
+        return "Empty data from polar-server"
 
-    load_bot_rule(bot, js)
+    load_bot_rule(bot, js, name)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,239 @@
-from polar.lang.eval import Bot
-from polar.lang.json_import import load_bot_rule_content
+import asyncio
+import os
+from concurrent.futures import Executor
+from typing import List, Optional
+
+from polar.lang import PolarParserError
+from polar.lang.eval import Bot, Rule
+from polar.lang.json_import import parse_content, load_rule, parse_batch, parse_content_async, \
+    parse_batch_async, parse_batch_stream
+from polar.lang.parser_pool import get_parser_pool
+from polar.util import map_chunked
 
 
 class JsonBotParser:
-    def __init__(self):
-        pass
+    def __init__(self, *, batch: Optional[bool]=None, executor: Optional[Executor]=None, chunk_size: int=64,
+                 concurrency: int=8):
+        if batch is None:
+            batch = bool(int(os.getenv("POLAR_PARSER_BATCH", "0")))
+        # Send all templates to polar-parser in one call
+        self._batch = batch
+        # Optional process pool to compile templates in parallel
+        self._executor = executor
+        self._chunk_size = chunk_size
+        # Max polar-parser processes started at once by async loading
+        self._concurrency = concurrency
+
+    def load_bot(self, templates, base: Optional[Bot]=None):
+        """
+        Builds bot from templates. With `base` bot only templates added or
+        changed since it are parsed, rules of the rest are reused.
+        """
+        templates, compiled, changed = self._split(templates, base)
+        return self._assemble(templates, compiled, self._parse_templates(changed))
+
+    async def load_bot_async(self, templates, base: Optional[Bot]=None):
+        """
+        Same as `load_bot` without blocking event loop. polar-parser runs
+        as asyncio subprocess, rules and indexes are built in executor.
+        Templates can be async iterable, then they are parsed by chunks
+        while next ones are fetched.
+        """
+        if hasattr(templates, "__aiter__") and self._executor is None:
+            return await self._load_bot_stream(templates, base)
+
+        if hasattr(templates, "__aiter__"):
+            templates = [template async for template in templates]
+
+        loop = asyncio.get_event_loop()
+        templates, compiled, changed = self._split(templates, base)
+
+        if self._executor is not None:
+            parsed = await loop.run_in_executor(None, self._parse_templates, changed)
+            return await loop.run_in_executor(None, self._build, templates, compiled, parsed)
+
+        js = await self._parse_json_async(changed)
+        return await loop.run_in_executor(None, self._build_from_json, templates, compiled, changed, js)
+
+    async def _load_bot_stream(self, templates, base: Optional[Bot]):
+        # Only id and version are kept, content is dropped once parsed
+        heads, compiled, changed = [], [], []
+
+        async def changed_templates():
+            async for template in templates:
+                head = {"id": template["id"], "version": template.get("version")}
+                rules = base.get_template_rules(head["id"], head["version"]) if base else None
+                heads.append(head)
+                compiled.append(rules)
+
+                if rules is None:
+                    changed.append(head)
+                    yield template
+
+        if self._batch:
+            js = await self._parse_json_stream(changed_templates())
+            js = [js.get(str(head["id"])) for head in changed]
+        else:
+            js = await self._parse_json_chunked(changed_templates())
 
-    def load_bot(self, templates):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._build_from_json, heads, compiled, changed, js)
+
+    async def _parse_json_chunked(self, templates):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        parsing = []
+        chunk = []
+
+        async for template in templates:
+            chunk.append(template)
+            if len(chunk) >= self._chunk_size:
+                parsing.append(asyncio.ensure_future(self._parse_json_async(chunk, semaphore)))
+                chunk = []
+
+        if chunk:
+            parsing.append(asyncio.ensure_future(self._parse_json_async(chunk, semaphore)))
+
+        return [template_js for chunk_js in await asyncio.gather(*parsing) for template_js in chunk_js]
+
+    @staticmethod
+    async def _parse_json_stream(templates):
+        """
+        Parsed json by template id of templates sent to one batch
+        polar-parser while they are fetched, failed ones are missing
+        """
+        results, errors = await parse_batch_stream((str(t["id"]), t["content"]) async for t in templates)
+        for template_id, error in errors.items():
+            print("Error", template_id, error)
+        return results
+
+    @staticmethod
+    def _split(templates, base: Optional[Bot]):
+        templates = list(templates)
+        compiled = [
+            base.get_template_rules(template["id"], template.get("version")) if base else None
+            for template in templates
+        ]
+
+        changed = [template for template, rules in zip(templates, compiled) if rules is None]
+        return templates, compiled, changed
+
+    @staticmethod
+    def _assemble(templates, compiled, parsed):
         bot = Bot()
+        parsed = iter(parsed)
 
-        for template in templates:
-            print("Loading", template["id"], template["content"])
-            result = load_bot_rule_content(bot, template["content"])
-            if result:
-                print("Error", template["id"], result)
+        for template, rules in zip(templates, compiled):
+            if rules is None:
+                rules = next(parsed)
+
+            if rules is None:
+                # Failed template isn't remembered, so it's parsed again
+                # on next load even with same version
+                continue
+
+            bot.add_template_rules(template["id"], template.get("version"), rules)
 
         return bot
+
+    @classmethod
+    def _build(cls, templates, compiled, parsed):
+        bot = cls._assemble(templates, compiled, parsed)
+        # Indexes are built here instead of first request in event loop
+        _ = bot.matcher
+        _ = bot.suggest_index
+        return bot
+
+    @classmethod
+    def _build_from_json(cls, templates, compiled, changed, js):
+        # Failed templates stay None, so they aren't remembered in bot
+        parsed = [
+            [load_rule(template_js, name=template["id"])] if template_js is not None else None
+            for template, template_js in zip(changed, js)
+        ]
+        return cls._build(templates, compiled, parsed)
+
+    async def _parse_json_async(self, templates, semaphore: Optional[asyncio.Semaphore]=None):
+        """
+        Parsed json of every template, None for failed ones
+        """
+        if not templates:
+            return []
+
+        # Shared by all chunks of one load
+        semaphore = semaphore or asyncio.Semaphore(self._concurrency)
+
+        if self._batch:
+            async with semaphore:
+                results, errors = await parse_batch_async([(str(t["id"]), t["content"]) for t in templates])
+            for template_id, error in errors.items():
+                print("Error", template_id, error)
+            return [results.get(str(t["id"])) for t in templates]
+
+        async def parse(template):
+            async with semaphore:
+                try:
+                    js = await parse_content_async(template["content"])
+                except PolarParserError as e:
+                    print("Error", template["id"], e)
+                    return None
+
+            if js is None:
+                print("Error", template["id"], "Empty data from polar-server")
+            return js
+
+        return await asyncio.gather(*(parse(template) for template in templates))
+
+    def _parse_templates(self, templates):
+        if self._executor is not None:
+            # Every chunk is parsed and compiled in worker process, only
+            # picklable fields are sent
+            templates = [{"id": t["id"], "content": t["content"]} for t in templates]
+            parse_chunk = JsonBotParser(batch=self._batch)._parse_templates
+            return map_chunked(self._executor, parse_chunk, templates, self._chunk_size)
+
+        if self._batch:
+            return self._parse_batch(templates)
+
+        pool = get_parser_pool()
+        if pool is not None:
+            # Templates are parsed on all pool workers simultaneously
+            return pool.map(self.parse_rules, templates)
+
+        return [self.parse_rules(template) for template in templates]
+
+    @classmethod
+    def _parse_batch(cls, templates):
+        if not templates:
+            return []
+
+        results, errors = parse_batch([(str(t["id"]), t["content"]) for t in templates])
+
+        rules = []
+        for template in templates:
+            template_id = str(template["id"])
+            if template_id in errors:
+                print("Error", template["id"], errors[template_id])
+                # Not cached in bot, parsed again on next load
+                rules.append(None)
+            else:
+                rules.append([load_rule(results[template_id], name=template["id"])])
+
+        return rules
+
+    @classmethod
+    def parse_rules(cls, template) -> Optional[List[Rule]]:
+        """
+        Rules of template, None if it failed to parse
+        """
+        print("Loading", template["id"], template["content"])
+        try:
+            js = parse_content(template["content"])
+        except PolarParserError as e:
+            print("Error", template["id"], e)
+            return None
+
+        if js is None:
+            print("Error", template["id"], "Empty data from polar-server")
+            return None
+
+        return [load_rule(js, name=template["id"])]
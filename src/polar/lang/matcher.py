@@ -0,0 +1,175 @@
+import math
+import re
+from collections import defaultdict
+from typing import List, Optional
+
+from polar.lang import Event, UserMessage, RuleNode
+from polar.lang.all import Regexp
+from polar.lang.regex_rule import RegexRule, fold_case
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+class RuleMatcher:
+    """
+    Bot-level prefilter for rule conditions.
+    Inverted index from literal words and stems of every RegexRule to rules.
+    Message is tokenized once and only rules whose literals are present
+    need full regex run.
+    """
+
+    def __init__(self, rules):
+        self._size = len(rules)
+        # Max match weight per char of message for every rule
+        self._weight_bounds = [self._rule_weight_bound(rule) for rule in rules]
+
+        # Rules evaluated for every message: pure `*` or non-regex conditions
+        self._always: List[int] = []
+        # Rule index and count of literal groups per RegexRule in rule condition
+        self._clauses = []
+        # Literal -> (clause index, group index)
+        self._index = defaultdict(list)
+        # Literals with non-word chars can cross token bounds, these are
+        # looked up in whole text
+        self._scan = []
+        self._max_len = 0
+
+        # RegexRule commands of rule condition, None if it has other commands
+        self._regex_conditions = [regex_condition(rule) for rule in rules]
+
+        for rule_idx, rule in enumerate(rules):
+            clauses = self._rule_clauses(rule)
+            if clauses is None or any(not groups for groups in clauses):
+                self._always.append(rule_idx)
+                continue
+
+            for groups in clauses:
+                clause_idx = len(self._clauses)
+                self._clauses.append((rule_idx, len(groups)))
+                for group_idx, group in enumerate(groups):
+                    for literal in set(group):
+                        self._add_literal(literal, (clause_idx, group_idx))
+
+    def candidates(self, event: Event) -> List[int]:
+        """
+        Sorted indices of rules which can match event.
+        """
+        if not isinstance(event, UserMessage):
+            return list(range(self._size))
+
+        text = fold_case(event.text)
+
+        hits = defaultdict(set)
+        for literal in self._present_literals(text):
+            for clause_idx, group_idx in self._index[literal]:
+                hits[clause_idx].add(group_idx)
+
+        found = set(self._always)
+        for clause_idx, groups in hits.items():
+            rule_idx, groups_count = self._clauses[clause_idx]
+            if len(groups) == groups_count:
+                found.add(rule_idx)
+
+        return sorted(found)
+
+    def ranked_candidates(self, event: Event) -> List[int]:
+        """
+        Candidates ordered by descending weight upper bound, then by index.
+        """
+        return sorted(self.candidates(event), key=lambda idx: (-self._weight_bounds[idx], idx))
+
+    def weight_bound(self, rule_idx: int, event: Event) -> float:
+        """
+        Upper bound of match weight of rule for event. Match weight is sum
+        of range weight by range length, ranges are not longer than message.
+        Bound of rule with negative weights is zero.
+        """
+        bound = self._weight_bounds[rule_idx]
+        if bound == math.inf or not isinstance(event, UserMessage):
+            return math.inf
+        return bound * len(event.text)
+
+    @property
+    def text_only(self) -> bool:
+        """
+        All rule conditions depend only on message text, so ranking of
+        same text is same for any context
+        """
+        return all(commands is not None for commands in self._regex_conditions)
+
+    def regex_condition(self, rule_idx: int) -> Optional[List[RegexRule]]:
+        return self._regex_conditions[rule_idx]
+
+    def _add_literal(self, literal, posting):
+        if literal not in self._index:
+            if WORD_RE.fullmatch(literal):
+                self._max_len = max(self._max_len, len(literal))
+            else:
+                self._scan.append(literal)
+        self._index[literal].append(posting)
+
+    def _present_literals(self, text):
+        present = set()
+
+        for m in WORD_RE.finditer(text):
+            token = m.group(0)
+            for start in range(len(token)):
+                for end in range(start + 1, min(len(token), start + self._max_len) + 1):
+                    part = token[start:end]
+                    if part in self._index:
+                        present.add(part)
+
+        present.update(literal for literal in self._scan if literal in text)
+
+        return present
+
+    @staticmethod
+    def _rule_weight_bound(rule) -> float:
+        # Weight per char is scaled by message length, which bounds only
+        # non-negative weights: shorter match of negative rule weighs more.
+        # So bound is never below zero
+        bound = 0
+        for command in rule.condition.commands:
+            if isinstance(command, RuleNode):
+                command = command.commands[0]
+
+            if isinstance(command, RegexRule):
+                bound = max(bound, command.max_weight())
+            elif isinstance(command, Regexp):
+                # Regexp ranges have default weight
+                bound = max(bound, 1)
+            else:
+                return math.inf
+
+        return bound
+
+    @staticmethod
+    def _rule_clauses(rule) -> Optional[List[List[List[str]]]]:
+        """
+        Literal groups for every RegexRule in rule condition.
+        RegexRule conditions don't break condition flow, so rule matches
+        if any of them matches. None if condition has other commands.
+        """
+        commands = regex_condition(rule)
+        if commands is None:
+            return None
+        return [command.required_literals() for command in commands]
+
+
+def regex_condition(rule) -> Optional[List[RegexRule]]:
+    """
+    RegexRule commands of rule condition if condition has nothing else.
+    Such condition depends only on message text.
+    """
+    commands = []
+    for command in rule.condition.commands:
+        if isinstance(command, RuleNode):
+            command = command.commands[0]
+
+        if not isinstance(command, RegexRule):
+            return None
+
+        commands.append(command)
+
+    return commands
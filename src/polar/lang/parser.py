@@ -1,6 +1,7 @@
 import html
 import itertools
-from typing import List
+from concurrent.futures import Executor
+from typing import List, Optional
 
 from bs4 import BeautifulSoup
 
@@ -8,6 +9,7 @@ from polar.lang import OutMessageEvent
 from polar.lang.all import SimpleResponse
 from polar.lang.eval import Bot, Rule
 from polar.lang.regex_rule import RegexRule
+from polar.util import map_chunked
 
 
 def _transform_template_text(text):
@@ -24,19 +26,46 @@ def _transform_template_text(text):
 
 
 class ArmBotParser:
-    def __init__(self):
-        pass
-
-    def load_bot(self, templates):
+    def __init__(self, *, executor: Optional[Executor]=None, chunk_size: int=64):
+        # Optional process pool to parse templates in parallel
+        self._executor = executor
+        self._chunk_size = chunk_size
+
+    def load_bot(self, templates, base: Optional[Bot]=None):
+        """
+        Builds bot from templates. With `base` bot only templates added or
+        changed since it are parsed, rules of the rest are reused.
+        """
         bot = Bot()
 
-        rules = self.parse_rules(templates)
-        bot.rules.extend(rules)
+        templates = list(templates)
+        compiled = [
+            base.get_template_rules(template["id"], template.get("version")) if base else None
+            for template in templates
+        ]
+
+        changed = [template for template, rules in zip(templates, compiled) if rules is None]
+        parsed = iter(self.parse_rules(changed, executor=self._executor, chunk_size=self._chunk_size))
+
+        for template, rules in zip(templates, compiled):
+            if rules is None:
+                rules = [next(parsed)]
+
+            bot.add_template_rules(template["id"], template.get("version"), rules)
 
         return bot
 
     @classmethod
-    def parse_rules(cls, templates) -> List[Rule]:
+    def parse_rules(cls, templates, *, executor: Optional[Executor]=None, chunk_size: int=64) -> List[Rule]:
+        """
+        Parses rule per template keeping templates order.
+        With `executor` templates are sharded to chunks parsed in parallel.
+        """
+        if executor is not None:
+            # Only picklable fields are sent to workers
+            templates = [{"id": t["id"], "content": t["content"]} for t in templates]
+            return map_chunked(executor, cls.parse_rules, templates, chunk_size)
+
         rules = []
 
         for template in templates:
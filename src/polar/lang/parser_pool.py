@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import queue
+import select
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from polar.lang import PolarParserError
+
+
+logger = logging.getLogger(__name__)
+
+# Every request and response is utf-8 payload prefixed with its length
+FRAME_HEADER = struct.Struct(">I")
+
+
+class PolarParserTimeout(PolarParserError):
+    pass
+
+
+class ParserWorker:
+    """
+    Long-lived polar-parser process speaking framed protocol over stdin/stdout.
+    Process is started on first call and restarted after crash or timeout.
+    """
+
+    def __init__(self, command: List[str]):
+        self._command = command
+        self._process: Optional[subprocess.Popen] = None
+
+    def call(self, payload: bytes, timeout: float) -> bytes:
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+
+        # Same deadline for request write, parser not reading stdin fills pipe
+        deadline = time.monotonic() + timeout
+        try:
+            self._write(FRAME_HEADER.pack(len(payload)) + payload, deadline)
+
+            size, = FRAME_HEADER.unpack(self._read(FRAME_HEADER.size, deadline))
+            return self._read(size, deadline)
+        except OSError as e:
+            self.stop()
+            raise PolarParserError("polar-parser pipe error: %s" % e)
+        except PolarParserError:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self._process is None:
+            return
+
+        self._process.kill()
+        self._process.wait()
+        for stream in (self._process.stdin, self._process.stdout):
+            stream.close()
+        self._process = None
+
+    def _start(self):
+        self.stop()
+        self._process = subprocess.Popen(self._command,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         bufsize=0)
+        os.set_blocking(self._process.stdin.fileno(), False)
+
+    def _write(self, data: bytes, deadline: float):
+        fd = self._process.stdin.fileno()
+        data = memoryview(data)
+        while data:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([], [fd], [], left)[1]:
+                raise PolarParserTimeout("polar-parser timed out")
+
+            try:
+                data = data[os.write(fd, data):]
+            except BlockingIOError:
+                pass
+
+    def _read(self, size: int, deadline: float) -> bytes:
+        fd = self._process.stdout.fileno()
+        data = b""
+        while len(data) < size:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                raise PolarParserTimeout("polar-parser timed out")
+
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise PolarParserError("polar-parser exited with code %s" % self._process.wait())
+            data += chunk
+
+        return data
+
+
+class ParserPool:
+    """
+    Fixed-size pool of polar-parser workers shared between threads.
+    """
+
+    def __init__(self, command: List[str], *, size: int=4, timeout: float=10.):
+        self._size = size
+        self._timeout = timeout
+        self._workers = [ParserWorker(command) for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def parse(self, content: str) -> Optional[dict]:
+        """
+        Parses template content. None if parser returned nothing.
+        Crashed worker is restarted and call retried once, timed out isn't.
+        """
+        worker = self._idle.get()
+        try:
+            try:
+                data = worker.call(content.encode(), self._timeout)
+            except PolarParserTimeout:
+                raise
+            except PolarParserError as e:
+                logger.warning("Restarting polar-parser: %s", e)
+                data = worker.call(content.encode(), self._timeout)
+        finally:
+            self._idle.put(worker)
+
+        return json.loads(data.decode()) if data else None
+
+    def map(self, fn, items):
+        """
+        Runs `fn` over items on all workers at once, keeping items order.
+        `fn` should catch parse errors and return distinct failure value
+        for item, one failed item shouldn't fail all.
+        """
+        with ThreadPoolExecutor(self._size) as executor:
+            return list(executor.map(fn, items))
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool: Optional[ParserPool] = None
+
+
+def get_parser_pool() -> Optional[ParserPool]:
+    """
+    Shared pool configured with POLAR_PARSER_POOL_SIZE. None if pool disabled
+    and polar-parser should be spawned for every template.
+    """
+    global _pool
+
+    size = int(os.getenv("POLAR_PARSER_POOL_SIZE", "0"))
+    if _pool is None and size > 0:
+        executable = os.getenv("POLAR_PARSER_EXECUTABLE")
+        if not executable:
+            raise RuntimeError("No polar-parser given!")
+
+        _pool = ParserPool([executable, "--serve"],
+                           size=size,
+                           timeout=float(os.getenv("POLAR_PARSER_TIMEOUT", "10")))
+
+    return _pool
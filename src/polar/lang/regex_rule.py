@@ -6,6 +6,31 @@ from polar.lang import PolarInternalError, ListN, AstNode, \
     Context, Interactivity, UserMessage, MatchRange, CommandResult
 
 
+RE_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+# Chars `re.IGNORECASE` treats as same besides lowercase, all mapped to
+# first one. Same as `_EXTRA_CASES` of `re` module
+_IGNORECASE_EXTRA = [
+    (0x69, 0x131), (0x73, 0x17f), (0x3bc, 0xb5), (0x3b9, 0x345, 0x1fbe), (0x390, 0x1fd3),
+    (0x3b0, 0x1fe3), (0x3b2, 0x3d0), (0x3b5, 0x3f5), (0x3b8, 0x3d1), (0x3ba, 0x3f0),
+    (0x3c0, 0x3d6), (0x3c1, 0x3f1), (0x3c3, 0x3c2), (0x3c6, 0x3d5), (0x432, 0x1c80),
+    (0x434, 0x1c81), (0x43e, 0x1c82), (0x441, 0x1c83), (0x442, 0x1c84, 0x1c85), (0x44a, 0x1c86),
+    (0x463, 0x1c87), (0xa64b, 0x1c88), (0x1e61, 0x1e9b), (0xfb06, 0xfb05),
+]
+_IGNORECASE_FOLD = {char: chars[0] for chars in _IGNORECASE_EXTRA for char in chars[1:]}
+# `re` lowercases İ to i, `str.lower` adds combining dot
+_IGNORECASE_LOWER = {0x130: 0x69}
+
+
+def fold_case(text: str) -> str:
+    """
+    Text with chars equal for `re.IGNORECASE` replaced by same char.
+    Unlike `str.casefold`, substring of text matched by regex ignoring
+    case is always substring of folded text after folding regex literal.
+    """
+    return text.translate(_IGNORECASE_LOWER).lower().translate(_IGNORECASE_FOLD)
+
+
 class RegexRule(AstNode):
     """
     Most useful rule for matching text with set of regexes.
@@ -53,6 +78,29 @@ class RegexRule(AstNode):
 
             return r
 
+        def literals(self):
+            """
+            Substrings folded by `fold_case` one of which must be in text matched by node.
+            None if node can match without any literal (`*` or regex syntax in words).
+            """
+            if self.arg == RegexRule.Any:
+                return None
+
+            words = self.arg if isinstance(self.arg, list) else [self.arg]
+            literals = [self._literal_word(w) for w in words]
+            if not literals or not all(literals):
+                return None
+
+            return literals
+
+        @staticmethod
+        def _literal_word(word):
+            if word.endswith("~"):
+                word = word[:-1]
+            if any(c in RE_SPECIAL_CHARS for c in word):
+                return None
+            return fold_case(word)
+
         @staticmethod
         def _format_word(word):
             if word.endswith("~"):
@@ -84,19 +132,42 @@ class RegexRule(AstNode):
         if not isinstance(event, UserMessage):
             return None
 
-        m = re.search(self._re, event.text)
-        value = None
-        if m:
-            match_result = MatchResult()
-            weight = self._calc_weight(m)
-            match_result.ranges.append(MatchRange(m.start(0), m.end(0), weight))
-            value = ListN([match_result])
+        match_result = self.match(event.text)
+        value = ListN([match_result]) if match_result is not None else None
 
         return EvalResult(state=CommandResult.OK, value=value)
 
+    def match(self, text: str) -> Optional[MatchResult]:
+        """
+        Synchronous matching without event and context, safe to call
+        from other threads
+        """
+        m = self._re.search(text)
+        if not m:
+            return None
+
+        match_result = MatchResult()
+        weight = self._calc_weight(m)
+        match_result.ranges.append(MatchRange(m.start(0), m.end(0), weight))
+        return match_result
+
     def build_re(self):
         return self._build_re(self.args)
 
+    def max_weight(self):
+        """
+        Upper bound of match weight per matched char
+        """
+        return sum(self._max_weight_arg(arg) for arg in self._args)
+
+    def required_literals(self):
+        """
+        Literal groups of non-`*` nodes. Regex can match only if text
+        contains at least one literal of every group.
+        """
+        groups = (arg.literals() for arg in self._args)
+        return [group for group in groups if group is not None]
+
     @classmethod
     def _init_args(cls, args):
         return [
@@ -144,6 +215,12 @@ class RegexRule(AstNode):
         else:
             return 1.
 
+    @classmethod
+    def _max_weight_arg(cls, arg):
+        if arg.arg == cls.Any and arg.weight is None:
+            return cls.ANY_WEIGHT
+        return arg.weight if arg.weight is not None else 1
+
     def _calc_weight(self, match):
         match_ranges = match.regs[1:]
         return sum(self._weight_arg(arg, match_range)
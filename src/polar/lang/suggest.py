@@ -0,0 +1,110 @@
+import bisect
+import heapq
+import re
+from collections import defaultdict
+from typing import List, Tuple
+
+from polar.lang import RuleNode
+from polar.lang.all import Regexp
+from polar.lang.regex_rule import RegexRule, fold_case
+
+
+# Plain words of regexp outside of escapes, char classes and quantifiers
+REGEXP_ESCAPE_RE = re.compile(r"\\.|\[[^\]]*\]")
+REGEXP_WORD_RE = re.compile(r"(?<!\w)([^\W\d_]{2,})(?![\w?*+{])")
+
+QUERY_PREFIX_RE = re.compile(r"\w+$")
+
+
+class SuggestIndex:
+    """
+    Completions of word user is typing from bot vocabulary.
+    Words and stems of RegexRule and plain words of Regexp conditions
+    are kept in sorted array, words with prefix are one slice of it.
+    Word weight is sum of rule weight by node weight over all rules.
+
+    Top words of prefixes shared by many words are prepared on build,
+    their slices are too long to select from on request.
+    """
+
+    # Prefixes of more words than this have prepared top words
+    WIDE_PREFIX = 256
+    # Max completions returned
+    MAX_LIMIT = 20
+
+    def __init__(self, rules):
+        weights = defaultdict(float)
+        for rule in rules:
+            for word, weight in self._rule_words(rule):
+                weights[word] += rule.weight * weight
+
+        self._words = sorted(weights)
+        self._weights = [weights[word] for word in self._words]
+
+        prefix_counts = defaultdict(int)
+        for word in self._words:
+            for size in range(1, len(word) + 1):
+                prefix_counts[word[:size]] += 1
+
+        # Prefix -> top word indices
+        self._wide = {
+            prefix: self._top(*self._range(prefix), self.MAX_LIMIT)
+            for prefix, count in prefix_counts.items()
+            if count > self.WIDE_PREFIX
+        }
+
+    def __len__(self):
+        return len(self._words)
+
+    def complete(self, prefix: str, limit: int=10) -> List[Tuple[str, float]]:
+        """
+        Words starting with prefix by descending weight
+        """
+        prefix = fold_case(prefix)
+        limit = min(limit, self.MAX_LIMIT)
+        if not prefix or limit <= 0:
+            return []
+
+        top = self._wide.get(prefix)
+        if top is None:
+            top = self._top(*self._range(prefix), limit)
+        return [(self._words[idx], self._weights[idx]) for idx in top[:limit]]
+
+    def suggest(self, query: str, limit: int=10) -> List[Tuple[str, float]]:
+        """
+        Query with last word completed
+        """
+        m = QUERY_PREFIX_RE.search(query)
+        if not m:
+            return []
+
+        head = query[:m.start()]
+        return [(head + word, weight) for word, weight in self.complete(m.group(0), limit)]
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self._words, prefix)
+        end = bisect.bisect_left(self._words, prefix + "\U0010ffff", start)
+        return start, end
+
+    def _top(self, start, end, limit):
+        # Equal weights in alphabetical order
+        return heapq.nsmallest(limit, range(start, end), key=lambda idx: (-self._weights[idx], idx))
+
+    @classmethod
+    def _rule_words(cls, rule):
+        for command in rule.condition.commands:
+            if isinstance(command, RuleNode):
+                command = command.commands[0]
+
+            if isinstance(command, RegexRule):
+                for node in command.args:
+                    literals = node.literals()
+                    if literals is None:
+                        continue
+                    weight = node.weight if node.weight is not None else 1
+                    for literal in literals:
+                        yield literal, weight
+            elif isinstance(command, Regexp):
+                for regexp in command.regexps:
+                    for word in REGEXP_WORD_RE.findall(REGEXP_ESCAPE_RE.sub(" ", regexp)):
+                        yield fold_case(word), 1
@@ -1,28 +1,187 @@
+import asyncio
+import logging
 from abc import abstractmethod
-from typing import List
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional
 
 import asyncpg
 
 
+logger = logging.getLogger(__name__)
+
+# Indexes for template queries: table, leading columns and statement
+TEMPLATE_INDEXES = [
+    ("suites", ["profile_id"],
+     "CREATE INDEX suites_profile_id_idx ON suites (profile_id)"),
+    ("templates", ["suite_id", "position", "id"],
+     "CREATE INDEX templates_suite_id_position_idx ON templates (suite_id, position, id)"),
+]
+
+
+def missing_indexes(existing: Dict[str, List[List[str]]]) -> List[str]:
+    """
+    Statements of recommended indexes not covered by existing ones.
+    :param existing: table -> columns of every index on table
+    """
+    return [
+        statement for table, columns, statement in TEMPLATE_INDEXES
+        if not any(index[:len(columns)] == columns for index in existing.get(table, []))
+    ]
+
+
 class LogicBaseBackend:
 
     @abstractmethod
     async def get_templates(self, bot_id) -> List[dict]:
         pass
 
+    async def iter_templates(self, bot_id) -> AsyncIterator[dict]:
+        """
+        Templates of `get_templates` streamed one by one
+        """
+        for template in await self.get_templates(bot_id):
+            yield template
+
+    @abstractmethod
+    async def get_template_versions(self, bot_id) -> List[dict]:
+        """
+        Only `id`, `version` and `created` of templates returned by `get_templates`
+        """
+        pass
+
+    @abstractmethod
+    async def get_change_markers(self, bot_ids: Iterable[str]) -> Dict[str, tuple]:
+        """
+        Cheap per-bot value which changes when any template of bot is
+        added, deleted, disabled or edited. Used for polling.
+        """
+        pass
+
+    @abstractmethod
+    async def subscribe(self, callback: Callable[[str], None], on_lost: Optional[Callable[[], None]]=None):
+        """
+        Call `callback` with bot id on every template change notification.
+        `on_lost` is called once if notifications stop coming, e.g. on
+        lost connection, subscription is over then.
+        """
+        pass
+
+    @abstractmethod
+    async def unsubscribe(self):
+        pass
+
 
 class LogicPostgresBackend(LogicBaseBackend):
-    def __init__(self, db: asyncpg.pool):
+    """
+    Templates of enabled suites of profile, profile id is bot id
+    """
+
+    TEMPLATES_QUERY = """
+        SELECT t.id, t.content, t.version, t.position, t.suite_id FROM suites s
+        JOIN templates t ON t.suite_id=s.id
+        WHERE
+            s.is_enabled AND
+            t.is_enabled AND
+            s.profile_id=$1
+        ORDER BY t.suite_id, t.position, t.id
+    """
+
+    def __init__(self, db: asyncpg.pool, *, channel: str="polar_templates", prefetch: int=256):
         self.db = db
+        self._channel = channel
+        # Rows fetched by cursor at once
+        self._prefetch = prefetch
+        # Connection kept for LISTEN and its listener
+        self._listen_connection = None
+        self._listener = None
+        self._on_lost = None
 
     async def get_templates(self, bot_id) -> List[dict]:
+        async with self.db.acquire() as connection:
+            return await connection.fetch(self.TEMPLATES_QUERY, bot_id)
+
+    async def iter_templates(self, bot_id) -> AsyncIterator[dict]:
+        # Rows come by `prefetch` ones, parsing starts before all are fetched
+        async with self.db.acquire() as connection:
+            async with connection.transaction():
+                async for template in connection.cursor(self.TEMPLATES_QUERY, bot_id, prefetch=self._prefetch):
+                    yield template
+
+    async def get_template_versions(self, bot_id) -> List[dict]:
         async with self.db.acquire() as connection:
             result = await connection.fetch("""
-                SELECT * FROM suites s
-                RIGHT JOIN templates t ON t.suite_id=s.id
-                WHERE 
+                SELECT t.id, t.version, t.created FROM suites s
+                JOIN templates t ON t.suite_id=s.id
+                WHERE
                     s.is_enabled AND
                     t.is_enabled AND
                     s.profile_id=$1
             """, bot_id)
             return result
+
+    async def get_change_markers(self, bot_ids: Iterable[str]) -> Dict[str, tuple]:
+        # Hash of id and version of every template: disabling one template
+        # and enabling other with same version changes it too
+        async with self.db.acquire() as connection:
+            result = await connection.fetch("""
+                SELECT s.profile_id, md5(string_agg(t.id::text || ':' || t.version::text, ',' ORDER BY t.id))
+                FROM suites s
+                JOIN templates t ON t.suite_id=s.id
+                WHERE
+                    s.is_enabled AND
+                    t.is_enabled AND
+                    s.profile_id = ANY($1::uuid[])
+                GROUP BY s.profile_id
+            """, [str(bot_id) for bot_id in bot_ids])
+            return {str(row[0]): tuple(row[1:]) for row in result}
+
+    async def subscribe(self, callback: Callable[[str], None], on_lost: Optional[Callable[[], None]]=None):
+        """
+        Listens channel notified by triggers from docs/design.md with
+        profile id of changed suite as payload
+        """
+        self._listen_connection = await self.db.acquire()
+        self._listener = lambda connection, pid, channel, payload: callback(payload)
+        self._on_lost = on_lost
+        self._listen_connection.add_termination_listener(self._on_terminated)
+        await self._listen_connection.add_listener(self._channel, self._listener)
+
+    async def unsubscribe(self):
+        if self._listen_connection is None:
+            return
+
+        connection, self._listen_connection = self._listen_connection, None
+        try:
+            connection.remove_termination_listener(self._on_terminated)
+            await connection.remove_listener(self._channel, self._listener)
+        finally:
+            await self.db.release(connection)
+
+    def _on_terminated(self, connection):
+        if connection is not self._listen_connection:
+            return
+
+        logger.warning("LISTEN connection closed, template change notifications stopped")
+        self._listen_connection = None
+        # Pool replaces closed connection on release
+        asyncio.ensure_future(self.db.release(connection))
+        if self._on_lost is not None:
+            self._on_lost()
+
+    async def verify_indexes(self) -> List[str]:
+        """
+        Statements of recommended indexes missing in database
+        """
+        async with self.db.acquire() as connection:
+            result = await connection.fetch("""
+                SELECT c.relname, array_agg(a.attname ORDER BY k.ord) FROM pg_index i
+                JOIN pg_class c ON c.oid=i.indrelid
+                JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord) ON true
+                JOIN pg_attribute a ON a.attrelid=c.oid AND a.attnum=k.attnum
+                WHERE c.relname = ANY($1::text[])
+                GROUP BY c.relname, i.indexrelid
+            """, sorted({table for table, _, _ in TEMPLATE_INDEXES}))
+
+        existing = {}
+        for table, columns in result:
+            existing.setdefault(table, []).append(list(columns))
+        return missing_indexes(existing)
@@ -1 +1,19 @@
+import os
 
+BOT_CACHE_SIZE = int(os.getenv("POLAR_LOGIC_BOT_CACHE_SIZE", "16"))
+
+# Processes compiling templates in parallel, 0 to compile in request process
+COMPILE_WORKERS = int(os.getenv("POLAR_LOGIC_COMPILE_WORKERS", "0"))
+
+# Directory for compiled bot snapshots, unset to disable them
+SNAPSHOT_DIR = os.getenv("POLAR_LOGIC_SNAPSHOT_DIR")
+
+# How cached bots pick up template changes: `notify` with Postgres LISTEN
+# (needs triggers from docs/design.md), `poll` or `off`
+REFRESH_MODE = os.getenv("POLAR_LOGIC_REFRESH", "poll")
+
+# Postgres channel notified on template changes
+REFRESH_CHANNEL = os.getenv("POLAR_LOGIC_REFRESH_CHANNEL", "polar_templates")
+
+# Seconds between checks of template changes in `poll` mode
+REFRESH_INTERVAL = float(os.getenv("POLAR_LOGIC_REFRESH_INTERVAL", "5"))
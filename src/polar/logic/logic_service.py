@@ -1,15 +1,212 @@
+import asyncio
+import functools
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from polar.lang.eval import Bot
 from polar.lang.json_parser import JsonBotParser
+from polar.logic import logic_conf
 from polar.logic.backend import LogicBaseBackend
+from polar.logic.snapshot import BotSnapshotStore, get_snapshot_store
+from polar.util import SingleFlight
+
+
+logger = logging.getLogger(__name__)
+
+
+def templates_revision(templates) -> tuple:
+    """
+    Hashable revision of template set. Changes when any template
+    is added, deleted or gets new `version`/`created`.
+    """
+    return tuple(sorted((str(t["id"]), t["version"], t["created"]) for t in templates))
 
 
 class LogicService:
-    def __init__(self, backend: LogicBaseBackend):
+    def __init__(self, backend: LogicBaseBackend, *, parser=None,
+                 cache_size=logic_conf.BOT_CACHE_SIZE, snapshots: Optional[BotSnapshotStore]=None):
         self._backend = backend
+        if parser is None:
+            executor = None
+            if logic_conf.COMPILE_WORKERS > 0:
+                executor = ProcessPoolExecutor(logic_conf.COMPILE_WORKERS)
+            parser = JsonBotParser(executor=executor)
+        self._parser = parser
+        self._cache_size = cache_size
+        # LRU of (bot_id, version) -> (revision, bot)
+        self._bots = OrderedDict()
+        self._flights = SingleFlight()
+        self._snapshots = snapshots or get_snapshot_store()
+
+        # Called with (bot_id, version, bot) when cached bot is replaced by refresh
+        self._refresh_listeners: List[Callable[[str, int, Bot], Awaitable[None]]] = []
+        # Bots kept by users, refreshed even when evicted from cache
+        self._tracked: Optional[Callable[[], Dict[Tuple[str, int], Bot]]] = None
+        # Bots being refreshed and bots changed again meanwhile
+        self._refreshing: Set[str] = set()
+        self._changed_again: Set[str] = set()
+        self._poll_task: Optional[asyncio.Task] = None
+        self._poll_interval = logic_conf.REFRESH_INTERVAL
+        self._subscribed = False
 
     async def get_bot(self, bot_id: str, version: int):
-        templates = await self._backend.get_templates(bot_id)
+        # Concurrent requests for same bot wait for one check and load
+        return await self._flights.run((bot_id, version), self._get_bot, bot_id, version)
+
+    async def _get_bot(self, bot_id: str, version: int, base: Optional[Bot]=None):
+        key = (bot_id, version)
+
+        # Revision is taken before templates, so bot changed in between
+        # is just recompiled once more on next call
+        versions = await self._backend.get_template_versions(bot_id)
+        revision = templates_revision(versions)
+
+        cached = self._bots.get(key)
+        if cached is not None and cached[0] == revision:
+            self._bots.move_to_end(key)
+            return cached[1]
+
+        return await self._load(key, revision, cached[1] if cached else base)
+
+    async def _load(self, key, revision, base: Optional[Bot]):
+        bot_id, version = key
+        loop = asyncio.get_event_loop()
+
+        if base is None and self._snapshots is not None:
+            bot = await loop.run_in_executor(None, self._snapshots.load, bot_id, version, revision)
+            if bot is not None:
+                self._put(key, revision, bot)
+                return bot
+
+        # Changed bot is recompiled incrementally from previous one
+        if hasattr(self._parser, "load_bot_async"):
+            # Templates are parsed while next ones are fetched
+            bot = await self._parser.load_bot_async(self._backend.iter_templates(bot_id), base=base)
+        else:
+            templates = await self._backend.get_templates(bot_id)
+            bot = await loop.run_in_executor(None, functools.partial(self._parser.load_bot, templates, base=base))
+
+        self._put(key, revision, bot)
 
-        parser = JsonBotParser()
-        bot = parser.load_bot(templates)
+        if self._snapshots is not None:
+            try:
+                await loop.run_in_executor(None, self._snapshots.save, bot_id, version, revision, bot)
+            except Exception:
+                logger.exception("Can't save snapshot of bot %s", bot_id)
 
         return bot
+
+    def add_refresh_listener(self, listener: Callable[[str, int, Bot], Awaitable[None]]):
+        self._refresh_listeners.append(listener)
+
+    def track_bots(self, tracked: Callable[[], Dict[Tuple[str, int], Bot]]):
+        """
+        Refresh also bots returned by `tracked` by (bot_id, version),
+        cache holds only few of bots kept by sessions
+        """
+        self._tracked = tracked
+
+    async def start_refresh(self, mode: str=logic_conf.REFRESH_MODE, interval: float=logic_conf.REFRESH_INTERVAL):
+        """
+        Recompile cached bots in background when their templates change
+        """
+        self._poll_interval = interval
+        if mode == "notify":
+            await self._backend.subscribe(self.on_bot_changed, self._on_notify_lost)
+            self._subscribed = True
+        elif mode == "poll":
+            self._poll_task = asyncio.ensure_future(self._poll(interval))
+        elif mode != "off":
+            raise ValueError("Unknown refresh mode %r" % mode)
+
+    async def stop_refresh(self):
+        if self._subscribed:
+            await self._backend.unsubscribe()
+            self._subscribed = False
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            await asyncio.wait([self._poll_task])
+            self._poll_task = None
+
+    def on_bot_changed(self, bot_id: str):
+        """
+        Schedule refresh of bot. Change during refresh schedules one more,
+        because refresh could have read templates before it.
+        """
+        bot_id = str(bot_id)
+        if bot_id in self._refreshing:
+            self._changed_again.add(bot_id)
+            return
+
+        self._refreshing.add(bot_id)
+        asyncio.ensure_future(self._refresh_until_stable(bot_id))
+
+    async def refresh(self, bot_id: str):
+        """
+        Recompile cached and tracked versions of bot incrementally. New bot
+        replaces old one in cache at once, requests get either old or new bot.
+        """
+        tracked = self._tracked() if self._tracked is not None else {}
+        keys = [key for key in self._bots if str(key[0]) == bot_id]
+        keys += [key for key in tracked if str(key[0]) == bot_id and key not in keys]
+
+        for key in keys:
+            cached = self._bots.get(key)
+            previous = cached[1] if cached is not None else tracked.get(key)
+            # Evicted bot is recompiled from tracked one
+            bot = await self._flights.run(key, self._get_bot, *key, base=previous)
+            if bot is previous:
+                continue
+
+            for listener in self._refresh_listeners:
+                await listener(key[0], key[1], bot)
+
+    async def _refresh_until_stable(self, bot_id: str):
+        try:
+            while True:
+                self._changed_again.discard(bot_id)
+                try:
+                    await self.refresh(bot_id)
+                except Exception:
+                    logger.exception("Can't refresh bot %s", bot_id)
+                if bot_id not in self._changed_again:
+                    break
+        finally:
+            self._refreshing.discard(bot_id)
+
+    def _on_notify_lost(self):
+        # Changes could be missed until polling starts, first poll
+        # checks all bots
+        logger.warning("Template change notifications lost, polling every %ss", self._poll_interval)
+        self._subscribed = False
+        if self._poll_task is None:
+            self._poll_task = asyncio.ensure_future(self._poll(self._poll_interval))
+
+    async def _poll(self, interval: float):
+        markers = {}
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                bot_ids = {str(bot_id) for bot_id, _ in self._bots}
+                if self._tracked is not None:
+                    bot_ids.update(str(bot_id) for bot_id, _ in self._tracked())
+                if not bot_ids:
+                    continue
+
+                current = await self._backend.get_change_markers(bot_ids)
+                for bot_id in bot_ids:
+                    # Bot loaded since last poll is checked too, it could
+                    # change after load. Unchanged bot costs one revision query
+                    if bot_id not in markers or markers[bot_id] != current.get(bot_id):
+                        self.on_bot_changed(bot_id)
+                markers = {bot_id: current.get(bot_id) for bot_id in bot_ids}
+            except Exception:
+                logger.exception("Can't poll template changes")
+
+    def _put(self, key, revision, bot):
+        self._bots[key] = (revision, bot)
+        self._bots.move_to_end(key)
+        while len(self._bots) > self._cache_size:
+            self._bots.popitem(last=False)
@@ -0,0 +1,109 @@
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from typing import Optional
+
+from polar.lang.eval import Bot
+from polar.logic import logic_conf
+
+
+logger = logging.getLogger(__name__)
+
+# Bump on any incompatible change of compiled bot classes
+SNAPSHOT_FORMAT = 3
+
+
+class BotSnapshotStore:
+    """
+    Compiled bots stored on disk, one file per (bot_id, version).
+    File is header pickle followed by bot pickle, so stale snapshot
+    is rejected without loading rules. Snapshot is valid only for
+    same format and template revision it was compiled from.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        # File -> (header, bot) loaded by preload
+        self._preloaded = {}
+
+    def preload(self) -> int:
+        """
+        Load all snapshots to memory. Called in supervisor before forking
+        workers, so workers share loaded bots copy-on-write instead of
+        loading own copies.
+        """
+        for file in glob.glob(os.path.join(self._path, "*.bot")):
+            try:
+                with open(file, "rb") as f:
+                    header = pickle.load(f)
+                    if header.get("format") != SNAPSHOT_FORMAT:
+                        continue
+                    self._preloaded[file] = (header, pickle.load(f))
+            except Exception:
+                logger.exception("Can't preload snapshot %s", file)
+
+        return len(self._preloaded)
+
+    def load(self, bot_id: str, version: int, revision: tuple) -> Optional[Bot]:
+        preloaded = self._preloaded.get(self._file(bot_id, version))
+        if preloaded is not None and preloaded[0] == self._header(bot_id, version, revision):
+            return preloaded[1]
+
+        try:
+            with open(self._file(bot_id, version), "rb") as f:
+                header = pickle.load(f)
+                if header != self._header(bot_id, version, revision):
+                    return None
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception("Can't load snapshot of bot %s", bot_id)
+            return None
+
+    def save(self, bot_id: str, version: int, revision: tuple, bot: Bot):
+        # Indexes are built before save, so loaded bot is ready to serve
+        _ = bot.matcher
+        _ = bot.suggest_index
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(self._header(bot_id, version, revision), f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(bot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._file(bot_id, version))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _file(self, bot_id, version):
+        name = hashlib.sha1(("%s:%s" % (bot_id, version)).encode()).hexdigest()
+        return os.path.join(self._path, name + ".bot")
+
+    @staticmethod
+    def _header(bot_id, version, revision):
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "bot_id": str(bot_id),
+            "version": version,
+            "revision": revision,
+        }
+
+
+_store: Optional[BotSnapshotStore] = None
+
+
+def get_snapshot_store() -> Optional[BotSnapshotStore]:
+    """
+    Shared store in POLAR_LOGIC_SNAPSHOT_DIR. None if snapshots disabled.
+    """
+    global _store
+
+    if _store is None and logic_conf.SNAPSHOT_DIR:
+        _store = BotSnapshotStore(logic_conf.SNAPSHOT_DIR)
+
+    return _store
@@ -1,38 +1,98 @@
-import uuid
+import time
 from abc import abstractmethod
+from typing import Dict, Tuple
 
 from polar.lang.eval import Bot
+from polar.meta import meta_conf
 
 
 class MetaBotStorageBaseBackend:
     @abstractmethod
-    async def init(self, bot: Bot):
+    async def init(self, bot_id: str, version: int, bot: Bot):
         pass
 
     @abstractmethod
     async def get(self, meta_bot_id):
         pass
 
+    @abstractmethod
+    def tracked(self) -> Dict[Tuple[str, int], Bot]:
+        """
+        Stored bots by (bot_id, version)
+        """
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
 
 class MetaMemoryBotStorageBackend(MetaBotStorageBaseBackend):
-    def __init__(self):
+    """
+    Bots shared by all sessions with same (bot_id, version).
+    Bots not accessed for `ttl` seconds are evicted.
+    """
+
+    def __init__(self, *, ttl: float=meta_conf.BOT_TTL):
+        # meta_bot_id -> [bot, last access time, (bot_id, version)]
         self.bots = {}
+        self._ttl = ttl
+        self._evictions = 0
+
+    async def init(self, bot_id: str, version: int, bot: Bot):
+        self._evict_expired()
 
-    async def init(self, bot: Bot):
-        meta_bot_id = uuid.uuid4()
-        self.bots[str(meta_bot_id)] = bot
+        meta_bot_id = "%s:%s" % (bot_id, version)
+        # Newer bot for same key replaces old one for all sessions
+        self.bots[meta_bot_id] = [bot, time.monotonic(), (bot_id, version)]
         return meta_bot_id
 
     async def get(self, meta_bot_id):
-        return self.bots.get(str(meta_bot_id))
+        entry = self.bots.get(str(meta_bot_id))
+        if entry is None:
+            return None
+
+        now = time.monotonic()
+        if now - entry[1] > self._ttl:
+            del self.bots[str(meta_bot_id)]
+            self._evictions += 1
+            return None
+
+        entry[1] = now
+        return entry[0]
+
+    def tracked(self) -> Dict[Tuple[str, int], Bot]:
+        self._evict_expired()
+        return {key: bot for bot, _, key in self.bots.values()}
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.bots),
+            "rules": sum(len(bot.rules) for bot, _, _ in self.bots.values()),
+            "evictions": self._evictions,
+        }
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [meta_bot_id for meta_bot_id, (_, accessed, _) in self.bots.items()
+                   if now - accessed > self._ttl]
+        for meta_bot_id in expired:
+            del self.bots[meta_bot_id]
+        self._evictions += len(expired)
 
 
 class MetaBotStorage:
     def __init__(self, backend: MetaBotStorageBaseBackend):
          self._backend = backend
 
-    async def init(self, bot: Bot):
-        return await self._backend.init(bot)
+    async def init(self, bot_id: str, version: int, bot: Bot):
+        return await self._backend.init(bot_id, version, bot)
 
     async def get(self, meta_bot_id):
         return await self._backend.get(meta_bot_id)
+
+    def tracked(self) -> Dict[Tuple[str, int], Bot]:
+        return self._backend.tracked()
+
+    def stats(self) -> dict:
+        return self._backend.stats()
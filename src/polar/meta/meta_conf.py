@@ -0,0 +1,41 @@
+import os
+
+# Seconds compiled bot is kept in meta storage after last access
+BOT_TTL = int(os.getenv("POLAR_META_BOT_TTL", "3600"))
+
+# Seconds session is kept in storage after last access, 0 to keep forever
+SESSION_TTL = int(os.getenv("POLAR_META_SESSION_TTL", str(24 * 60 * 60)))
+
+# Attempts to write session context changes over concurrent writes
+SESSION_UPDATE_RETRIES = int(os.getenv("POLAR_META_SESSION_UPDATE_RETRIES", "5"))
+
+# Max sessions kept by in-memory session storage
+SESSION_MEMORY_SIZE = int(os.getenv("POLAR_META_SESSION_MEMORY_SIZE", "100000"))
+
+# Sessions cached in process in front of Redis, 0 to disable local cache
+SESSION_LOCAL_SIZE = int(os.getenv("POLAR_META_SESSION_LOCAL_SIZE", "10000"))
+
+# Seconds locally cached session is served without Redis read
+SESSION_LOCAL_REFRESH = float(os.getenv("POLAR_META_SESSION_LOCAL_REFRESH", "60"))
+
+# Evaluate rules best-first and stop when no rule can beat best match
+EXECUTOR_BEST_FIRST = bool(int(os.getenv("POLAR_META_EXECUTOR_BEST_FIRST", "1")))
+
+# Best matches kept in executor state, unset to keep all (or best for best-first)
+EXECUTOR_TOP_K = int(os.environ["POLAR_META_EXECUTOR_TOP_K"]) if os.getenv("POLAR_META_EXECUTOR_TOP_K") else None
+
+# Rule conditions evaluated concurrently, 0 to evaluate one by one
+EXECUTOR_CONCURRENCY = int(os.getenv("POLAR_META_EXECUTOR_CONCURRENCY", "0"))
+
+# Seconds for single rule condition evaluation, 0 for no timeout
+EXECUTOR_CONDITION_TIMEOUT = float(os.getenv("POLAR_META_EXECUTOR_CONDITION_TIMEOUT", "0"))
+
+# Workers matching regex conditions outside of event loop, 0 to match inline
+EXECUTOR_MATCH_WORKERS = int(os.getenv("POLAR_META_EXECUTOR_MATCH_WORKERS", "0"))
+
+# Use processes instead of threads for matching, avoids GIL for big bots
+# at cost of pickling rule regexes on every request
+EXECUTOR_MATCH_PROCESSES = bool(int(os.getenv("POLAR_META_EXECUTOR_MATCH_PROCESSES", "0")))
+
+# Rankings of prefetched texts kept for following text requests, 0 to disable prefetch
+PREFETCH_CACHE_SIZE = int(os.getenv("POLAR_META_PREFETCH_CACHE_SIZE", "10000"))
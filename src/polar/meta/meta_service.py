@@ -1,14 +1,19 @@
-import copy
 import logging
 import time
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
 
-from polar.lang import Event, Interactivity
+from polar.lang import Event, Interactivity, OverlayContext, UserMessage
 from polar.lang.eval import Executor
 from polar.logic.backend import LogicPostgresBackend
+from polar.logic import logic_conf
 from polar.logic.logic_service import LogicService
+from polar.meta import meta_conf
 from polar.meta.bot_storage import MetaBotStorage, MetaMemoryBotStorageBackend
+from polar.meta.prefetch import MetaPrefetchCache
 from polar.meta.session_storage import MetaSessionStorage, MetaSession, \
-    MetaRedisSessionStorageBackend
+    MetaRedisSessionStorageBackend, MetaCachedSessionStorageBackend
 
 
 logger = logging.getLogger(__name__)
@@ -19,22 +24,60 @@ class MetaService:
         self.db = db
 
         self._bots = MetaBotStorage(MetaMemoryBotStorageBackend())
-        self._sessions = MetaSessionStorage(MetaRedisSessionStorageBackend(redis))
-
-        self._logic_service = LogicService(LogicPostgresBackend(db))
-
-        self._executor = Executor()
+        sessions_backend = MetaRedisSessionStorageBackend(redis)
+        if meta_conf.SESSION_LOCAL_SIZE > 0:
+            sessions_backend = MetaCachedSessionStorageBackend(sessions_backend)
+        self._sessions = MetaSessionStorage(sessions_backend)
+
+        self._logic_backend = LogicPostgresBackend(db, channel=logic_conf.REFRESH_CHANNEL)
+        self._logic_service = LogicService(self._logic_backend)
+        self._logic_service.add_refresh_listener(self._on_bot_refresh)
+        # Bots of sessions are refreshed even when evicted from logic cache
+        self._logic_service.track_bots(self._bots.tracked)
+
+        match_executor = None
+        if meta_conf.EXECUTOR_MATCH_WORKERS > 0:
+            pool_cls = ProcessPoolExecutor if meta_conf.EXECUTOR_MATCH_PROCESSES else ThreadPoolExecutor
+            match_executor = pool_cls(meta_conf.EXECUTOR_MATCH_WORKERS)
+
+        self._executor = Executor(best_first=meta_conf.EXECUTOR_BEST_FIRST,
+                                  top_k=meta_conf.EXECUTOR_TOP_K,
+                                  concurrency=meta_conf.EXECUTOR_CONCURRENCY or None,
+                                  condition_timeout=meta_conf.EXECUTOR_CONDITION_TIMEOUT or None,
+                                  match_executor=match_executor)
+
+        self._prefetched = MetaPrefetchCache() if meta_conf.PREFETCH_CACHE_SIZE > 0 else None
+
+    async def start(self):
+        try:
+            for statement in await self._logic_backend.verify_indexes():
+                logger.warning("Missing index for template queries, recommended: %s", statement)
+        except Exception:
+            logger.exception("Can't verify template indexes")
+
+        await self._logic_service.start_refresh()
+
+    async def stop(self):
+        await self._logic_service.stop_refresh()
+
+    async def _on_bot_refresh(self, bot_id: str, version: int, bot):
+        # Sessions get refreshed bot on next request
+        await self._bots.init(bot_id, version, bot)
 
     async def init_session(self, bot_id: str) -> str:
-        bot = await self._logic_service.get_bot(bot_id, 0)
+        version = 0
+        bot = await self._logic_service.get_bot(bot_id, version)
 
-        meta_bot_id = await self._bots.init(bot)
+        meta_bot_id = await self._bots.init(bot_id, version, bot)
 
         session = MetaSession()
         session.meta_bot_id = meta_bot_id
-        session.context = {
-            "update_every_request": bot_id,
-        }
+        session.bot_id = bot_id
+        session.bot_version = version
+        session.context = {}
+        if logic_conf.REFRESH_MODE == "off":
+            # Without background refresh bot is checked for changes every request
+            session.context["update_every_request"] = bot_id
 
         session_id = await self._sessions.init(session)
 
@@ -49,20 +92,79 @@ class MetaService:
             return None
 
         s1 = time.perf_counter()
-        if session.context.get("update_every_request"):
-            # Debug flag to update bot templates every request
-            public_bot_id = session.context["update_every_request"]
-            bot = await self._logic_service.get_bot(public_bot_id, 0)
-        else:
-            bot = await self._bots.get(session.meta_bot_id)
+        bot = await self._get_request_bot(session)
         s2 = time.perf_counter()
         print("Parsing %.3fsec" % (s2 - s1))
 
-        context = copy.deepcopy(session.context)
-        context["random_seed"] = 123
+        # Transient keys are in base layer, so they aren't saved to session
+        context = OverlayContext(ChainMap({"random_seed": 123}, session.context))
 
         s1 = time.perf_counter()
-        resp_event = await self._executor.execute_event(event=event, bot=bot, context=context, inter=inter)
+        sorted_results = None
+        if self._prefetched is not None and isinstance(event, UserMessage):
+            sorted_results = self._prefetched.get(session_id, event.text, session.bot_id, session.bot_version, bot)
+        if sorted_results is None:
+            sorted_results = await self._executor.rank(event=event, bot=bot, context=context)
+        resp_event = await self._executor.execute_ranked(sorted_results, event=event, bot=bot,
+                                                         context=context, inter=inter)
         s2 = time.perf_counter()
         print("Exec %.3fsec" % (s2 - s1))
+
+        # Context changes of whole request are written back at once
+        if context.changes or context.deleted:
+            await self._sessions.update_context(session_id, session, context.changes, context.deleted)
+
         return resp_event
+
+    async def prefetch(self, event: UserMessage, session_id) -> bool:
+        """
+        Rank rules for text user is typing, so `push_request` with same
+        text only evaluates best rule flow. Only rankings of bots with
+        text-only conditions are cached, others depend on context.
+        """
+        if self._prefetched is None:
+            return False
+
+        session = await self._sessions.get(session_id)
+        if not session:
+            logger.info("Can't find session %s", session_id)
+            return False
+
+        bot = await self._get_request_bot(session)
+        if not bot.matcher.text_only:
+            return False
+
+        # Conditions are not allowed to change context, so session is untouched
+        context = OverlayContext(session.context)
+        sorted_results = await self._executor.rank(event=event, bot=bot, context=context)
+        self._prefetched.put(session_id, event.text, session.bot_id, session.bot_version, bot, sorted_results)
+        return True
+
+    async def suggest(self, query: str, session_id, limit: int=10) -> List[Tuple[str, float]]:
+        """
+        Completions of query from session bot vocabulary
+        """
+        session = await self._sessions.get(session_id)
+        if not session:
+            logger.info("Can't find session %s", session_id)
+            return []
+
+        bot = await self._get_request_bot(session)
+        return bot.suggest_index.suggest(query, limit)
+
+    async def _get_request_bot(self, session: MetaSession):
+        if session.context.get("update_every_request"):
+            # Debug flag to update bot templates every request
+            public_bot_id = session.context["update_every_request"]
+            return await self._logic_service.get_bot(public_bot_id, 0)
+
+        return await self._get_session_bot(session)
+
+    async def _get_session_bot(self, session: MetaSession):
+        bot = await self._bots.get(session.meta_bot_id)
+        if bot is None and session.bot_id is not None:
+            # Evicted from storage after being idle, shared again on reload
+            bot = await self._logic_service.get_bot(session.bot_id, session.bot_version)
+            await self._bots.init(session.bot_id, session.bot_version, bot)
+
+        return bot
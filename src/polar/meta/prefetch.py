@@ -0,0 +1,47 @@
+import weakref
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from polar.lang import MatchResult
+from polar.lang.eval import Bot
+from polar.meta import meta_conf
+
+
+class MetaPrefetchCache:
+    """
+    Rankings computed by `prefetch` requests for later `text` requests
+    with same text in same session and same bot id and version.
+    Ranking is reused only with same bot instance it was computed with,
+    reloaded bot never gets stale ranking. Bot is referenced weakly, so
+    cache doesn't keep replaced bots alive.
+
+    Text is key as is: regex ranges and so weights depend on case and
+    whitespace of text.
+    """
+
+    def __init__(self, *, size: int=meta_conf.PREFETCH_CACHE_SIZE):
+        self._size = size
+        # (session_id, text, bot_id, bot_version) -> (weak ref of bot, sorted results)
+        self._rankings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, session_id: str, text: str, bot_id: str, bot_version: int, bot: Bot,
+            sorted_results: List[Tuple[int, MatchResult]]):
+        key = (session_id, text, bot_id, bot_version)
+        self._rankings[key] = (weakref.ref(bot), sorted_results)
+        self._rankings.move_to_end(key)
+        while len(self._rankings) > self._size:
+            self._rankings.popitem(last=False)
+
+    def get(self, session_id: str, text: str, bot_id: str, bot_version: int,
+            bot: Bot) -> Optional[List[Tuple[int, MatchResult]]]:
+        key = (session_id, text, bot_id, bot_version)
+        cached = self._rankings.get(key)
+        if cached is None or cached[0]() is not bot:
+            self.misses += 1
+            return None
+
+        self._rankings.move_to_end(key)
+        self.hits += 1
+        return cached[1]
@@ -1,30 +1,61 @@
 import json
+import time
 import uuid
+from collections import OrderedDict
 from abc import abstractmethod
+from typing import Optional
 
 from polar import util
+from polar.meta import meta_conf
+
+
+class MetaSessionConflict(RuntimeError):
+    pass
 
 
 class MetaSession:
     def __init__(self):
         self.meta_bot_id = None
+        self.bot_id = None
+        self.bot_version = 0
         self.context = {}
+        # Incremented on every write for optimistic concurrency
+        self.version = 0
 
     @classmethod
     def from_json(cls, jstr):
         session = MetaSession()
         js = json.loads(jstr)
         session.meta_bot_id = str(js["meta_bot_id"])
+        session.bot_id = js.get("bot_id")
+        session.bot_version = js.get("bot_version", 0)
         session.context = js["context"]
+        session.version = js.get("version", 0)
         return session
 
     def to_json(self):
         obj = {
             "meta_bot_id": self.meta_bot_id,
+            "bot_id": self.bot_id,
+            "bot_version": self.bot_version,
             "context": self.context,
+            "version": self.version,
         }
         return json.dumps(obj, default=util.json_serial)
 
+    def with_changes(self, changes: dict, deleted=()) -> "MetaSession":
+        """
+        Copy of session with context changes applied
+        """
+        session = MetaSession()
+        session.meta_bot_id = self.meta_bot_id
+        session.bot_id = self.bot_id
+        session.bot_version = self.bot_version
+        session.context = {k: v for k, v in self.context.items() if k not in deleted}
+        session.context.update(changes)
+        session.version = self.version
+        return session
+
 
 class MetaSessionStorageBaseBackend:
     @abstractmethod
@@ -35,38 +66,200 @@ class MetaSessionStorageBaseBackend:
     async def get(self, meta_session_id):
         pass
 
+    @abstractmethod
+    async def update(self, meta_session_id, session: MetaSession) -> Optional[bool]:
+        """
+        Stores session if stored one has same version and increments version.
+        False if session was changed by someone else, None if session has gone
+        and isn't stored again.
+        """
+        pass
+
 
 class MetaMemorySessionStorageBackend(MetaSessionStorageBaseBackend):
-    def __init__(self):
-        self.sessions = {}
+    """
+    Sessions expire `ttl` seconds after last access. Over `max_size`
+    least recently used sessions are evicted.
+    """
+
+    def __init__(self, *, ttl: float=meta_conf.SESSION_TTL, max_size: int=meta_conf.SESSION_MEMORY_SIZE):
+        # session id -> [session, expire time], least recently used first
+        self.sessions = OrderedDict()
+        self._ttl = ttl
+        self._max_size = max_size
+        self.evictions = 0
 
     async def init(self, session: MetaSession):
         session_id = uuid.uuid4()
-        self.sessions[str(session_id)] = session
+        self._put(str(session_id), session)
         return session_id
 
     async def get(self, meta_session_id):
-        return self.sessions.get(str(meta_session_id))
+        entry = self.sessions.get(str(meta_session_id))
+        if entry is None:
+            return None
+
+        if self._expired(entry):
+            del self.sessions[str(meta_session_id)]
+            self.evictions += 1
+            return None
+
+        entry[1] = self._expire_time()
+        self.sessions.move_to_end(str(meta_session_id))
+        return entry[0]
+
+    async def update(self, meta_session_id, session: MetaSession) -> Optional[bool]:
+        entry = self.sessions.get(str(meta_session_id))
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self.sessions[str(meta_session_id)]
+            self.evictions += 1
+            return None
+        if entry[0].version != session.version:
+            return False
+
+        session.version += 1
+        self._put(str(meta_session_id), session)
+        return True
+
+    def _put(self, session_id, session):
+        self.sessions[session_id] = [session, self._expire_time()]
+        self.sessions.move_to_end(session_id)
+
+        # With same ttl for all least recently used session expires first
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if len(self.sessions) <= self._max_size and not self._expired(oldest):
+                break
+            self.sessions.popitem(last=False)
+            self.evictions += 1
+
+    def _expire_time(self):
+        return time.monotonic() + self._ttl if self._ttl > 0 else None
+
+    @staticmethod
+    def _expired(entry):
+        return entry[1] is not None and entry[1] <= time.monotonic()
 
 
 class MetaRedisSessionStorageBackend(MetaSessionStorageBaseBackend):
-    def __init__(self, redis):
+    # Compare-and-set of session by version in one round-trip.
+    # KEYS[1] session key, ARGV: expected version, new session json, ttl.
+    # Returns 1 if stored, 0 on version conflict, -1 if session has gone
+    UPDATE_SCRIPT = """
+        local current = redis.call('GET', KEYS[1])
+        if not current then
+            return -1
+        end
+        if (cjson.decode(current)['version'] or 0) ~= tonumber(ARGV[1]) then
+            return 0
+        end
+        if tonumber(ARGV[3]) > 0 then
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        else
+            redis.call('SET', KEYS[1], ARGV[2])
+        end
+        return 1
+    """
+
+    def __init__(self, redis, *, ttl: int=meta_conf.SESSION_TTL):
         self._redis = redis
         self._prefix = "polar:session:"
+        self._ttl = ttl
 
     async def init(self, session: MetaSession):
         session_id = uuid.uuid4()
-        await self._redis.set(self._prefix + str(session_id), session.to_json())
+        await self._redis.set(self._prefix + str(session_id), session.to_json(), expire=self._ttl)
         return session_id
 
     async def get(self, meta_session_id):
-        result = await self._redis.get(self._prefix + str(meta_session_id), encoding="utf-8")
+        key = self._prefix + str(meta_session_id)
+        if self._ttl > 0:
+            # Sliding expiry in same round-trip
+            pipe = self._redis.pipeline()
+            get = pipe.get(key, encoding="utf-8")
+            pipe.expire(key, self._ttl)
+            await pipe.execute()
+            result = await get
+        else:
+            result = await self._redis.get(key, encoding="utf-8")
         return MetaSession.from_json(result) if result else None
 
+    async def update(self, meta_session_id, session: MetaSession) -> Optional[bool]:
+        expected = session.version
+        session.version += 1
+        updated = await self._redis.eval(self.UPDATE_SCRIPT,
+                                         keys=[self._prefix + str(meta_session_id)],
+                                         args=[expected, session.to_json(), self._ttl])
+        if updated != 1:
+            session.version = expected
+        return None if updated == -1 else updated == 1
+
+
+class MetaCachedSessionStorageBackend(MetaSessionStorageBaseBackend):
+    """
+    Process-local LRU of sessions in front of other (Redis) backend.
+    Writes go through to remote backend. Local copy changed by other process
+    is detected by version check of remote update and dropped, same as
+    local copy of session expired remotely.
+    Remote session is reread every `refresh` seconds, which also keeps its
+    sliding expiry.
+    """
+
+    def __init__(self, remote: MetaSessionStorageBaseBackend, *,
+                 size: int=meta_conf.SESSION_LOCAL_SIZE, refresh: float=meta_conf.SESSION_LOCAL_REFRESH):
+        self._remote = remote
+        self._size = size
+        self._refresh = refresh
+        # session id -> [session, remote read time], least recently used first
+        self._local = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def init(self, session: MetaSession):
+        session_id = await self._remote.init(session)
+        self._put(str(session_id), session)
+        return session_id
+
+    async def get(self, meta_session_id):
+        key = str(meta_session_id)
+        entry = self._local.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self._refresh:
+            self._local.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        session = await self._remote.get(meta_session_id)
+        if session is None:
+            self._local.pop(key, None)
+            return None
+
+        self._put(key, session)
+        return session
+
+    async def update(self, meta_session_id, session: MetaSession) -> Optional[bool]:
+        updated = await self._remote.update(meta_session_id, session)
+        if updated:
+            self._put(str(meta_session_id), session)
+        else:
+            # Stale or gone remotely
+            self._local.pop(str(meta_session_id), None)
+        return updated
+
+    def _put(self, key, session):
+        self._local[key] = [session, time.monotonic()]
+        self._local.move_to_end(key)
+        while len(self._local) > self._size:
+            self._local.popitem(last=False)
+
 
 class MetaSessionStorage:
-    def __init__(self, backend: MetaSessionStorageBaseBackend):
+    def __init__(self, backend: MetaSessionStorageBaseBackend, *,
+                 update_retries: int=meta_conf.SESSION_UPDATE_RETRIES):
         self._backend = backend
+        self._update_retries = update_retries
 
     async def init(self, session: MetaSession):
         return await self._backend.init(session)
@@ -74,3 +267,23 @@ class MetaSessionStorage:
     async def get(self, meta_session_id):
         return await self._backend.get(meta_session_id)
 
+    async def update_context(self, meta_session_id, session: MetaSession,
+                             changes: dict, deleted=()) -> Optional[MetaSession]:
+        """
+        Writes context changes made by request in one backend call.
+        If session was written concurrently, changes are applied over fresh session.
+        :return: stored session or None if session has gone
+        """
+        for _ in range(self._update_retries):
+            updated = session.with_changes(changes, deleted)
+            stored = await self._backend.update(meta_session_id, updated)
+            if stored is None:
+                return None
+            if stored:
+                return updated
+
+            session = await self._backend.get(meta_session_id)
+            if session is None:
+                return None
+
+        raise MetaSessionConflict("Can't update session %s" % meta_session_id)
@@ -5,3 +5,23 @@ LOGIC_POSTGRES_DSN = os.getenv("POLAR_LOGIC_POSTGRES_DSN")
 PROXY_PORT = int(os.getenv("POLAR_PROXY_RUN_PORT", "5000"))
 
 LOGIC_REDIS_DSN = os.getenv("POLAR_LOGIC_REDIS_DSN")
+
+# Worker processes serving same port with SO_REUSEPORT, 1 to serve in main process
+PROXY_WORKERS = int(os.getenv("POLAR_PROXY_WORKERS", "1"))
+
+# Seconds worker waits for open requests on graceful shutdown
+PROXY_SHUTDOWN_TIMEOUT = float(os.getenv("POLAR_PROXY_SHUTDOWN_TIMEOUT", "30"))
+
+# Seconds worker waits for open websocket requests on shutdown before
+# closing connections, less than PROXY_SHUTDOWN_TIMEOUT
+PROXY_DRAIN_TIMEOUT = float(os.getenv("POLAR_PROXY_DRAIN_TIMEOUT", "10"))
+
+# Requests of one websocket connection handled concurrently
+PROXY_WS_WINDOW = int(os.getenv("POLAR_PROXY_WS_WINDOW", "8"))
+
+# Order of handling websocket requests: `strict` one by one, `text` only
+# text requests in order, `none` no order
+PROXY_WS_ORDERING = os.getenv("POLAR_PROXY_WS_ORDERING", "text")
+
+# Completions returned for suggest request
+PROXY_SUGGEST_LIMIT = int(os.getenv("POLAR_PROXY_SUGGEST_LIMIT", "10"))
@@ -1,15 +1,18 @@
 import asyncio
+import functools
 import logging
 import time
+import weakref
 
 import aiohttp
 import aioredis
 import asyncpg
-from aiohttp import web
+from aiohttp import web, WSCloseCode
 
 from polar.lang import UserMessage, Interactivity, Event, OutMessageEvent
 from polar.meta.meta_service import MetaService
-from polar.proxy import proxy_conf, legacy
+from polar.proxy import proxy_conf, legacy, supervisor
+from polar.proxy.ws_dispatcher import WsDispatcher
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +33,32 @@ class WsInteractivity(Interactivity):
         await self.ws.send_json(send)
 
 
+async def handle_request(ws, meta: MetaService, session_id: str, js: dict):
+    if js["type"] == "text":
+        event = UserMessage(js["text"])
+        s1 = time.perf_counter()
+        inter = WsInteractivity(ws, request_id=js["request_id"])
+        await meta.push_request(event, session_id, inter)
+        s2 = time.perf_counter()
+        print("Last request %.3fsec" % (s2 - s1))
+    elif js["type"] == "prefetch":
+        cached = await meta.prefetch(UserMessage(js["text"]), session_id)
+        await ws.send_json({"type": "prefetch", "status": "ok" if cached else "skipped", "request_id": js["request_id"]})
+    elif js["type"] == "suggest":
+        suggestions = await meta.suggest(js.get("query", ""), session_id, limit=proxy_conf.PROXY_SUGGEST_LIMIT)
+        await ws.send_json({
+            "type": "suggest",
+            "suggestions": [{"text": text, "weight": weight} for text, weight in suggestions],
+            "request_id": js["request_id"],
+        })
+    else:
+        await ws.send_json({"type": "error", "text": f"Unknown type '{js['type']}'", "code": 12, "request_id": js["request_id"]})
+
+
+async def send_request_error(ws, js: dict, exc: Exception):
+    await ws.send_json({"type": "error", "text": "Request failed", "code": 14, "request_id": js["request_id"]})
+
+
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
@@ -37,60 +66,111 @@ async def websocket_handler(request):
     meta: MetaService = request.app["meta"]
 
     session_id: str = None
+    dispatcher = WsDispatcher(window=proxy_conf.PROXY_WS_WINDOW,
+                              ordering=proxy_conf.PROXY_WS_ORDERING,
+                              on_error=functools.partial(send_request_error, ws))
+    request.app["websockets"][ws] = dispatcher
 
     logger.debug("New websocket request")
 
-    while not ws.closed:
-        msg = await ws.receive()
-
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            logger.info("Got %s", msg.data)
-            js = msg.json()
-
-            if not js.get("request_id"):
-                await ws.send_json({"type": "error", "text": "Missing 'request_id' in message", "code": 11})
-                continue
-
-            if not js.get("type"):
-                await ws.send_json({"type": "error", "text": "Missing 'type' in message", "code": 10, "request_id": js["request_id"]})
-                continue
-
-            if js["type"] == "hello":
-                session_id = await meta.init_session(js["bot_id"])
-            elif js["type"] == "text":
-                event = UserMessage(js["text"])
-                s1 = time.perf_counter()
-                inter = WsInteractivity(ws, request_id=js["request_id"])
-                await meta.push_request(event, session_id, inter)
-                s2 = time.perf_counter()
-                print("Last request %.3fsec" % (s2 - s1))
-            else:
-                await ws.send_json({"type": "error", "text": f"Unknown type '{js['type']}'", "code": 12, "request_id": js["request_id"]})
-                continue
-
-        elif msg.type == aiohttp.WSMsgType.CLOSE:
-            logger.info("websocket connection closed")
-        elif msg.type == aiohttp.WSMsgType.ERROR:
-            logger.info("ws connection closed with exception %s" % ws.exception())
+    try:
+        while not ws.closed:
+            msg = await ws.receive()
+
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                logger.info("Got %s", msg.data)
+                js = msg.json()
+
+                if not js.get("request_id"):
+                    await ws.send_json({"type": "error", "text": "Missing 'request_id' in message", "code": 11})
+                    continue
+
+                if request.app["stopping"].is_set():
+                    # Open requests are finishing, connection is closed after them
+                    await ws.send_json({"type": "error", "text": "Server shutdown", "code": 13, "request_id": js["request_id"]})
+                    continue
+
+                if not js.get("type"):
+                    await ws.send_json({"type": "error", "text": "Missing 'type' in message", "code": 10, "request_id": js["request_id"]})
+                    continue
+
+                if js["type"] == "hello":
+                    # Handled inline, next requests need session
+                    session_id = await meta.init_session(js["bot_id"])
+                else:
+                    await dispatcher.dispatch(js, functools.partial(handle_request, ws, meta, session_id, js))
+
+            elif msg.type == aiohttp.WSMsgType.CLOSE:
+                logger.info("websocket connection closed")
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                logger.info("ws connection closed with exception %s" % ws.exception())
+    finally:
+        await dispatcher.close()
 
     return ws
 
 
-def main():
-    app = web.Application()
+async def on_startup(app):
+    # Pools are created in every worker after fork
+    app["db"] = await asyncpg.create_pool(dsn=proxy_conf.LOGIC_POSTGRES_DSN)
+    app["redis"] = await aioredis.create_redis_pool(proxy_conf.LOGIC_REDIS_DSN)
+    app["meta"] = MetaService(db=app["db"], redis=app["redis"])
+    await app["meta"].start()
 
-    logging.basicConfig(level=logging.INFO)
 
-    db = asyncio.get_event_loop().run_until_complete(asyncpg.create_pool(dsn=proxy_conf.LOGIC_POSTGRES_DSN))
-    redis = asyncio.get_event_loop().run_until_complete(aioredis.create_redis_pool(proxy_conf.LOGIC_REDIS_DSN))
+async def on_shutdown(app):
+    # New connections are not accepted already, new requests are refused
+    app["stopping"].set()
+    connections = list(app["websockets"].items())
+
+    joins = [dispatcher.join() for _, dispatcher in connections]
+    if joins:
+        try:
+            await asyncio.wait_for(asyncio.gather(*joins), proxy_conf.PROXY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Open requests not finished in %ss, closing connections", proxy_conf.PROXY_DRAIN_TIMEOUT)
+
+    # Clients reconnect to other workers
+    for ws, _ in connections:
+        await ws.close(code=WSCloseCode.GOING_AWAY, message=b"Server shutdown")
 
-    app["meta"] = MetaService(db=db, redis=redis)
+
+async def on_cleanup(app):
+    await app["meta"].stop()
+    app["redis"].close()
+    await app["redis"].wait_closed()
+    await app["db"].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    # Open websocket -> its request dispatcher
+    app["websockets"] = weakref.WeakKeyDictionary()
+    app["stopping"] = asyncio.Event()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
     app.add_routes([
         web.get('/ws', websocket_handler),
         web.post('/Chat.init', legacy.chat_init),
         web.post('/Chat.request', legacy.chat_request),
     ])
-    web.run_app(app, port=proxy_conf.PROXY_PORT)
+    return app
+
+
+def run_worker(reuse_port=False):
+    web.run_app(create_app(), port=proxy_conf.PROXY_PORT, reuse_port=reuse_port,
+                shutdown_timeout=proxy_conf.PROXY_SHUTDOWN_TIMEOUT)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    if proxy_conf.PROXY_WORKERS > 1:
+        supervisor.Supervisor(lambda: run_worker(reuse_port=True), proxy_conf.PROXY_WORKERS).run()
+    else:
+        run_worker()
 
 
 if __name__ == "__main__":
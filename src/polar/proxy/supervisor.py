@@ -0,0 +1,130 @@
+import gc
+import logging
+import os
+import signal
+import time
+from typing import Callable, Set
+
+from polar.logic.snapshot import get_snapshot_store
+
+
+logger = logging.getLogger(__name__)
+
+SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD}
+
+
+class Supervisor:
+    """
+    Forks workers serving same port with SO_REUSEPORT, kernel balances
+    connections between them.
+
+    Compiled bot snapshots are loaded before fork and shared by workers
+    copy-on-write. Every worker opens own database and redis pools.
+
+    SIGHUP restarts workers gracefully: new workers are started first,
+    old ones get SIGTERM, close websockets with GOING_AWAY and finish
+    open requests. SIGTERM and SIGINT stop all workers. Crashed workers
+    are restarted.
+    """
+
+    # Seconds before restart of worker which crashed right after start
+    RESTART_DELAY = 1.
+
+    def __init__(self, target: Callable[[], None], workers: int):
+        self._target = target
+        self._size = workers
+        # Pid -> start time
+        self._workers = {}
+        # Old workers draining connections after restart
+        self._retiring: Set[int] = set()
+        self._stopping = False
+
+    def run(self):
+        self._preload()
+
+        # Signals are handled synchronously in loop below, workers
+        # restore mask after fork
+        self._mask = signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        try:
+            for _ in range(self._size):
+                self._spawn()
+
+            while self._workers or self._retiring:
+                info = signal.sigtimedwait(SIGNALS, 1.)
+                if info is not None:
+                    self._on_signal(info.si_signo)
+                self._reap()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, self._mask)
+
+        logger.info("All workers stopped")
+
+    def _preload(self):
+        store = get_snapshot_store()
+        if store is None:
+            return
+
+        logger.info("Preloaded %s bot snapshots", store.preload())
+        # Loaded bots are never collected, so collector doesn't write to
+        # their pages in workers
+        gc.freeze()
+
+    def _on_signal(self, signo):
+        if signo == signal.SIGHUP and not self._stopping:
+            logger.info("Restarting workers")
+            old = list(self._workers)
+            for _ in range(self._size):
+                self._spawn()
+            for pid in old:
+                self._retire(pid)
+        elif signo in (signal.SIGTERM, signal.SIGINT) and not self._stopping:
+            logger.info("Stopping workers")
+            self._stopping = True
+            for pid in list(self._workers):
+                self._retire(pid)
+
+    def _retire(self, pid):
+        del self._workers[pid]
+        self._retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+
+            logger.error("Worker %s exited with status %s, restarting", pid, status)
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = time.monotonic()
+            return
+
+        code = 0
+        try:
+            signal.pthread_sigmask(signal.SIG_SETMASK, self._mask)
+            self._target()
+        except Exception:
+            logger.exception("Worker failed")
+            code = 1
+        finally:
+            os._exit(code)
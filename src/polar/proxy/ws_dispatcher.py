@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Requests of these types are outdated by next one of same type
+CANCEL_STALE_TYPES = frozenset(["prefetch", "suggest"])
+
+
+class Ordering:
+    # All requests are handled one by one in order of arrival
+    STRICT = "strict"
+    # `text` requests are handled in order, others overlap with them
+    TEXT = "text"
+    # Requests are handled independently
+    NONE = "none"
+
+    ALL = (STRICT, TEXT, NONE)
+
+
+class WsDispatcher:
+    """
+    Runs requests of one websocket connection as tasks, so slow reply
+    doesn't block reading next messages. Replies are matched by client
+    with `request_id`.
+
+    At most `window` requests are in flight, `dispatch` waits for free
+    slot and connection stops reading meanwhile. Requests in same order
+    chain start after previous one is done.
+
+    If handler fails, `on_error` is called with request and exception
+    to reply to client, which otherwise waits for reply forever.
+    """
+
+    def __init__(self, *, window: int=8, ordering: str=Ordering.TEXT,
+                 on_error: Optional[Callable[[dict, Exception], Awaitable[None]]]=None):
+        if ordering not in Ordering.ALL:
+            raise ValueError("Unknown ordering %r, expected one of %s" % (ordering, Ordering.ALL))
+
+        self._window = asyncio.Semaphore(window)
+        self._ordering = ordering
+        self._on_error = on_error
+        self._tasks = set()
+        # Chain name -> last task in chain
+        self._chains: Dict[str, asyncio.Task] = {}
+        # Request type -> last task which is cancelled by newer request
+        self._stale: Dict[str, asyncio.Task] = {}
+
+    async def dispatch(self, js: dict, handler: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        """
+        Start handling request `js` with `handler` call
+        """
+        await self._window.acquire()
+
+        request_type = js["type"]
+        if request_type in CANCEL_STALE_TYPES:
+            stale = self._stale.get(request_type)
+            if stale is not None:
+                stale.cancel()
+
+        chain = self._chain(request_type)
+        previous = self._chains.get(chain) if chain is not None else None
+
+        task = asyncio.ensure_future(self._run(js, handler, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+        if chain is not None:
+            self._chains[chain] = task
+        if request_type in CANCEL_STALE_TYPES:
+            self._stale[request_type] = task
+
+        return task
+
+    async def join(self):
+        """
+        Wait for all dispatched requests
+        """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def close(self):
+        """
+        Cancel all requests, used when connection is closed and replies
+        can't be sent
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def _chain(self, request_type) -> Optional[str]:
+        if self._ordering == Ordering.STRICT:
+            return "all"
+        if self._ordering == Ordering.TEXT and request_type == "text":
+            return "text"
+        return None
+
+    async def _run(self, js, handler, previous: Optional[asyncio.Task]):
+        if previous is not None and not previous.done():
+            # Result and errors of previous request are not our business
+            await asyncio.wait([previous])
+
+        try:
+            await handler()
+        except asyncio.CancelledError:
+            logger.debug("Request %s cancelled", js.get("request_id"))
+            raise
+        except Exception as e:
+            logger.exception("Request %s failed", js.get("request_id"))
+            if self._on_error is not None:
+                try:
+                    await self._on_error(js, e)
+                except Exception:
+                    logger.exception("Can't report failure of request %s", js.get("request_id"))
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._window.release()
+        for tasks in (self._chains, self._stale):
+            for key, last in list(tasks.items()):
+                if last is task:
+                    del tasks[key]
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import uuid
 
@@ -16,3 +17,44 @@ def json_serial(obj):
         return str(obj)
 
     raise TypeError("Type %s not serializable" % type(obj))
+
+
+def map_chunked(executor, fn, items, chunk_size):
+    """
+    Maps `fn` over chunks of items on executor and flattens results in items order.
+    `fn` takes list of items and returns list of results.
+    """
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    return [result for chunk in executor.map(fn, chunks) for result in chunk]
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with same key into one call. Callers coming
+    while call is in flight await its result and get its error. Nothing
+    is kept after call is done, so failed call is retried by next caller.
+    """
+
+    def __init__(self):
+        # Key -> call in flight
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, fn, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._done(key, done))
+
+        # Call isn't cancelled with one of waiting callers
+        return await asyncio.shield(call)
+
+    def _done(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            # Error is retrieved even if all callers are gone
+            call.exception()
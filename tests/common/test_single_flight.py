@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from polar.util import SingleFlight
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class Loader:
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    async def load(self, key):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        if self.fail:
+            raise RuntimeError("load failed %s" % key)
+        return object()
+
+
+def test_coalesce():
+    flights = SingleFlight()
+    loader = Loader()
+
+    async def run():
+        return await asyncio.gather(*(flights.run("a", loader.load, "a") for _ in range(10)),
+                                    flights.run("b", loader.load, "b"))
+
+    results = _run(run())
+    assert loader.calls == 2
+    assert all(result is results[0] for result in results[:10])
+    assert results[10] is not results[0]
+    assert len(flights) == 0
+
+    # Nothing cached after call
+    _run(flights.run("a", loader.load, "a"))
+    assert loader.calls == 3
+
+
+def test_error_to_all_not_cached():
+    flights = SingleFlight()
+    loader = Loader(fail=True)
+
+    async def run():
+        return await asyncio.gather(*(flights.run("a", loader.load, "a") for _ in range(5)),
+                                    return_exceptions=True)
+
+    results = _run(run())
+    assert loader.calls == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    loader.fail = False
+    assert _run(flights.run("a", loader.load, "a")) is not None
+    assert loader.calls == 2
+
+
+def test_cancelled_caller_doesnt_cancel_call():
+    flights = SingleFlight()
+    loader = Loader()
+
+    async def run():
+        first = asyncio.ensure_future(flights.run("a", loader.load, "a"))
+        second = asyncio.ensure_future(flights.run("a", loader.load, "a"))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert _run(run()) is not None
+    assert loader.calls == 1
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Minimal polar-parser replacement for tests.
+Understands `$ words` and `# response` lines. Content `error` fails,
+`crash` exits the process, `sleep` hangs it. Content with first line
+`once <error|crash|sleep> <path>` fails once: first call creates file
+at path and fails, next ones parse the rest of content.
+
+Without arguments parses whole stdin once, with `--serve` reads
+length-prefixed frames until stdin is closed, with `--batch` parses
+newline-delimited records. In batch mode empty content gets null
+result, `garbage` gets malformed output line and `crash` exits.
+"""
+import json
+import os
+import struct
+import sys
+import time
+
+FRAME_HEADER = struct.Struct(">I")
+
+
+def _term(value):
+    if value == "*":
+        return {"node": "term", "type": "kleine", "value": value}
+    return {"node": "term", "type": "string", "value": value}
+
+
+def resolve(content):
+    if content.startswith("once "):
+        header, _, content = content.partition("\n")
+        _, failure, path = header.split()
+        if not os.path.exists(path):
+            open(path, "w").close()
+            return failure
+    return content
+
+
+def parse(content):
+    content = resolve(content)
+    if content == "crash":
+        sys.exit(3)
+    if content == "sleep":
+        time.sleep(60)
+    if not content.strip() or content == "error":
+        return None
+
+    flow = []
+    for line in content.split("\n"):
+        line = line.strip()
+        if line.startswith("$"):
+            args = [_term(word) for word in line[1:].split()]
+            flow.append({"node": "rule", "args": [{"node": "regexp_rule", "args": args}]})
+        elif line.startswith("#"):
+            flow.append({"node": "response", "args": [_term(line[1:].strip())]})
+
+    return {"node": "flow", "flow": flow}
+
+
+def _read(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def serve():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        header = _read(stdin, FRAME_HEADER.size)
+        if header is None:
+            return
+        size, = FRAME_HEADER.unpack(header)
+        js = parse(_read(stdin, size).decode())
+        payload = json.dumps(js).encode() if js is not None else b""
+        stdout.write(FRAME_HEADER.pack(len(payload)) + payload)
+        stdout.flush()
+
+
+def batch():
+    for line in sys.stdin:
+        record = json.loads(line)
+        content = resolve(record["content"])
+        if content == "garbage":
+            # Broken output line instead of record
+            sys.stdout.write("{garbage\n")
+            continue
+        if content == "crash":
+            sys.exit(1)
+        if content == "error":
+            out = {"id": record["id"], "error": "Syntax error"}
+        else:
+            out = {"id": record["id"], "result": parse(content)}
+        sys.stdout.write(json.dumps(out) + "\n")
+
+
+if __name__ == "__main__":
+    if "--serve" in sys.argv[1:]:
+        serve()
+    elif "--batch" in sys.argv[1:]:
+        batch()
+    else:
+        js = parse(sys.stdin.read())
+        if js is not None:
+            sys.stdout.write(json.dumps(js))
@@ -0,0 +1,40 @@
+import pytest
+
+from polar.lang import OverlayContext
+
+
+def test_overlay():
+    base = {"a": 1, "b": 2}
+    context = OverlayContext(base)
+
+    context["c"] = 3
+    context["a"] = 10
+    del context["b"]
+
+    assert dict(context) == {"a": 10, "c": 3}
+    assert len(context) == 2
+    assert "b" not in context
+    assert base == {"a": 1, "b": 2}
+
+    assert context.changes == {"a": 10, "c": 3}
+    assert context.deleted == ["b"]
+
+
+def test_overlay_same_value_not_dirty():
+    context = OverlayContext({"a": 1, "b": 2})
+
+    context["a"] = 1
+    del context["b"]
+    context["b"] = 2
+    assert context.changes == {}
+    assert context.deleted == []
+
+    context["c"] = 1
+    del context["c"]
+    assert context.changes == {}
+    with pytest.raises(KeyError):
+        del context["c"]
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
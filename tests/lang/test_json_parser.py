@@ -0,0 +1,218 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from polar.lang import parser_pool
+from polar.lang.json_parser import JsonBotParser
+from polar.lang.parser_pool import ParserPool
+from polar.lang.regex_rule import RegexRule
+
+FAKE_PARSER = os.path.join(os.path.dirname(__file__), "fake_polar_parser.py")
+
+TEMPLATES = [
+    {"id": "t1", "version": 1, "content": "$ cat\n# dog"},
+    {"id": "t2", "version": 1, "content": "error"},
+    {"id": "t3", "version": 1, "content": "$ * fox *\n# owl"},
+]
+
+
+@pytest.fixture(autouse=True)
+def fake_parser(monkeypatch):
+    monkeypatch.setenv("POLAR_PARSER_EXECUTABLE", FAKE_PARSER)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_load_bot(batch):
+    bot = JsonBotParser(batch=batch).load_bot(TEMPLATES)
+
+    assert [rule.name for rule in bot.rules] == ["t1", "t3"]
+    assert bot.rules[1].condition.commands[0].commands[0].args == \
+           [RegexRule.Node(RegexRule.Any), RegexRule.Node("fox"), RegexRule.Node(RegexRule.Any)]
+
+
+def test_batch_errors_per_template():
+    templates = TEMPLATES + [
+        {"id": "t4", "version": 1, "content": ""},
+        {"id": "t5", "version": 1, "content": "garbage"},
+        {"id": "t6", "version": 1, "content": "$ owl\n# fox"},
+    ]
+    bot = JsonBotParser(batch=True).load_bot(templates)
+
+    # Failed, empty and malformed results don't break batch and aren't cached
+    assert [rule.name for rule in bot.rules] == ["t1", "t3", "t6"]
+    for template_id in ["t2", "t4", "t5"]:
+        assert bot.get_template_rules(template_id, 1) is None
+    assert len(bot.get_template_rules("t1", 1)) == 1
+
+
+def test_batch_failed_template_parsed_again(tmp_path):
+    templates = [
+        {"id": "t1", "version": 1, "content": "$ cat\n# dog"},
+        {"id": "t2", "version": 1, "content": "once garbage %s\n$ fox\n# owl" % (tmp_path / "failed")},
+    ]
+    parser = JsonBotParser(batch=True)
+
+    bot = parser.load_bot(templates)
+    assert [rule.name for rule in bot.rules] == ["t1"]
+
+    bot2 = parser.load_bot(templates, base=bot)
+    assert [rule.name for rule in bot2.rules] == ["t1", "t2"]
+
+
+def test_load_bot_parallel():
+    with ProcessPoolExecutor(2) as executor:
+        bot = JsonBotParser(executor=executor, chunk_size=1).load_bot(TEMPLATES)
+
+    assert [rule.name for rule in bot.rules] == ["t1", "t3"]
+    assert bot.rules[0].condition.commands[0].commands[0].args == [RegexRule.Node("cat")]
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_load_bot_async(batch):
+    parser = JsonBotParser(batch=batch)
+    bot = asyncio.get_event_loop().run_until_complete(parser.load_bot_async(TEMPLATES))
+
+    assert [rule.name for rule in bot.rules] == ["t1", "t3"]
+    assert bot.get_template_rules("t2", 1) is None
+    assert bot.rules[1].condition.commands[0].commands[0].args == \
+           [RegexRule.Node(RegexRule.Any), RegexRule.Node("fox"), RegexRule.Node(RegexRule.Any)]
+    # Indexes are ready before first request
+    assert bot._matcher is not None
+
+    templates = TEMPLATES + [{"id": "t4", "version": 1, "content": "$ owl\n# fox"}]
+    bot2 = asyncio.get_event_loop().run_until_complete(parser.load_bot_async(templates, base=bot))
+    assert bot2.get_template_rules("t1", 1) is bot.get_template_rules("t1", 1)
+    assert [rule.name for rule in bot2.rules] == ["t1", "t3", "t4"]
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_load_bot_stream(batch):
+    fetched = []
+
+    async def stream(templates):
+        for template in templates:
+            fetched.append(template["id"])
+            await asyncio.sleep(0)
+            yield template
+
+    parser = JsonBotParser(batch=batch, chunk_size=2)
+    loop = asyncio.get_event_loop()
+    bot = loop.run_until_complete(parser.load_bot_async(stream(TEMPLATES)))
+
+    assert fetched == ["t1", "t2", "t3"]
+    assert [rule.name for rule in bot.rules] == ["t1", "t3"]
+    assert bot.get_template_rules("t2", 1) is None
+
+    templates = TEMPLATES + [{"id": "t4", "version": 1, "content": "$ owl\n# fox"}]
+    bot2 = loop.run_until_complete(parser.load_bot_async(stream(templates), base=bot))
+    assert bot2.get_template_rules("t3", 1) is bot.get_template_rules("t3", 1)
+    assert [rule.name for rule in bot2.rules] == ["t1", "t3", "t4"]
+
+
+def test_stream_batch_one_process(monkeypatch):
+    calls = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def counting_exec(*args, **kwargs):
+        calls.append(args)
+        return await create_subprocess_exec(*args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", counting_exec)
+
+    async def stream(templates):
+        for template in templates:
+            await asyncio.sleep(0)
+            yield template
+
+    templates = [{"id": "t%d" % i, "version": 1, "content": "$ word%d\n# %d" % (i, i)} for i in range(10)]
+    parser = JsonBotParser(batch=True, chunk_size=2)
+    loop = asyncio.get_event_loop()
+    bot = loop.run_until_complete(parser.load_bot_async(stream(templates)))
+
+    assert len(calls) == 1
+    assert [rule.name for rule in bot.rules] == [t["id"] for t in templates]
+
+    # Nothing changed, nothing to parse
+    loop.run_until_complete(parser.load_bot_async(stream(templates), base=bot))
+    assert len(calls) == 1
+
+
+def test_stream_batch_crash():
+    async def stream(templates):
+        for template in templates:
+            yield template
+
+    templates = [{"id": "t1", "version": 1, "content": "crash"}] + \
+                [{"id": "t%d" % i, "version": 1, "content": "$ word%d\n# %d" % (i, i)} for i in range(2, 2000)]
+    parser = JsonBotParser(batch=True)
+    bot = asyncio.get_event_loop().run_until_complete(parser.load_bot_async(stream(templates)))
+
+    # Templates after crash aren't parsed and aren't remembered
+    assert bot.rules == []
+    assert bot.get_template_rules("t2", 1) is None
+
+
+def _flaky_templates(tmp_path, failure):
+    return [
+        {"id": "t1", "version": 1, "content": "$ cat\n# dog"},
+        {"id": "t2", "version": 1, "content": "once %s %s\n$ fox\n# owl" % (failure, tmp_path / "failed")},
+    ]
+
+
+def test_failed_template_parsed_again(tmp_path):
+    templates = _flaky_templates(tmp_path, "error")
+    parser = JsonBotParser(batch=False)
+
+    bot = parser.load_bot(templates)
+    assert [rule.name for rule in bot.rules] == ["t1"]
+    assert bot.get_template_rules("t2", 1) is None
+
+    # Same version is parsed again and succeeds
+    bot2 = parser.load_bot(templates, base=bot)
+    assert [rule.name for rule in bot2.rules] == ["t1", "t2"]
+    assert bot2.get_template_rules("t1", 1) is bot.get_template_rules("t1", 1)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+@pytest.mark.parametrize("stream", [False, True])
+def test_async_failed_template_parsed_again(tmp_path, batch, stream):
+    async def iterate(templates):
+        for template in templates:
+            yield template
+
+    async def load(templates, base=None):
+        return await JsonBotParser(batch=batch).load_bot_async(iterate(templates) if stream else templates, base=base)
+
+    templates = _flaky_templates(tmp_path, "garbage" if batch else "error")
+    loop = asyncio.get_event_loop()
+
+    bot = loop.run_until_complete(load(templates))
+    assert [rule.name for rule in bot.rules] == ["t1"]
+    assert bot.get_template_rules("t2", 1) is None
+
+    bot2 = loop.run_until_complete(load(templates, base=bot))
+    assert [rule.name for rule in bot2.rules] == ["t1", "t2"]
+
+
+def test_pool_failure_parsed_again(tmp_path, monkeypatch):
+    pool = ParserPool([FAKE_PARSER, "--serve"], size=2, timeout=0.5)
+    monkeypatch.setattr(parser_pool, "_pool", pool)
+    try:
+        templates = _flaky_templates(tmp_path, "sleep")
+        parser = JsonBotParser(batch=False)
+
+        # Timed out template isn't cached as empty
+        bot = parser.load_bot(templates)
+        assert [rule.name for rule in bot.rules] == ["t1"]
+        assert bot.get_template_rules("t2", 1) is None
+
+        bot2 = parser.load_bot(templates, base=bot)
+        assert [rule.name for rule in bot2.rules] == ["t1", "t2"]
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import random
+
+import pytest
+
+from polar.lang import UserMessage, Context, Interactivity, OutMessageEvent, RuleNode
+from polar.lang.all import Flow, SimpleResponse, Regexp
+from polar.lang.eval import Bot, Rule
+from polar.lang.matcher import RuleMatcher
+from polar.lang.regex_rule import RegexRule
+
+WORDS = ["cat", "dog", "fox", "зайч~", "bird", "кот"]
+
+
+def _rule(*conditions):
+    return Rule(
+        condition=Flow(list(conditions)),
+        flow=Flow([SimpleResponse([OutMessageEvent("1")])]),
+    )
+
+
+def _bot():
+    bot = Bot()
+    bot.add_rule(_rule(RegexRule([RegexRule.Any])))
+    for word in WORDS:
+        bot.add_rule(_rule(RegexRule([word])))
+        bot.add_rule(_rule(RegexRule([RegexRule.Any, word, RegexRule.Any])))
+    for w1, w2 in itertools.product(WORDS, WORDS):
+        bot.add_rule(_rule(RegexRule([RegexRule.Any, w1, RegexRule.Any, w2, RegexRule.Any])))
+    return bot
+
+
+def _matched(bot, text, indices):
+    inter = Interactivity()
+    matched = []
+    for rule_idx in indices:
+        resp = asyncio.get_event_loop().run_until_complete(
+            bot.rules[rule_idx].condition.eval(UserMessage(text), Context(), inter))
+        if resp.value is not None and resp.value.value:
+            matched.append(rule_idx)
+    return matched
+
+
+def test_literals():
+    assert RegexRule.Node("Cat").literals() == ["cat"]
+    assert RegexRule.Node("зайч~").literals() == ["зайч"]
+    assert RegexRule.Node(["a~", "B"]).literals() == ["a", "b"]
+    assert RegexRule.Node(RegexRule.Any).literals() is None
+    assert RegexRule.Node("c.t").literals() is None
+    assert RegexRule.Node(["cat", "d?g"]).literals() is None
+
+    rule = RegexRule([RegexRule.Any, "cat", RegexRule.Any, ["dog", "fox"]])
+    assert rule.required_literals() == [["cat"], ["dog", "fox"]]
+
+
+def test_candidates():
+    bot = Bot()
+    bot.add_rule(_rule(RegexRule([RegexRule.Any])))
+    bot.add_rule(_rule(RegexRule(["cat", "dog"])))
+    bot.add_rule(_rule(RuleNode([RegexRule(["fox"])])))
+    bot.add_rule(_rule(Regexp(["bird"])))
+    bot.add_rule(_rule(RegexRule(["fox"]), RegexRule(["cat"])))
+
+    matcher = RuleMatcher(bot.rules)
+    assert matcher.candidates(UserMessage("CAT dog")) == [0, 1, 3, 4]
+    assert matcher.candidates(UserMessage("a fox")) == [0, 2, 3, 4]
+    assert matcher.candidates(UserMessage("nothing")) == [0, 3]
+
+
+def test_candidates_not_words():
+    bot = Bot()
+    bot.add_rule(_rule(RegexRule(["license plate"])))
+    bot.add_rule(_rule(RegexRule(["e-mail", RegexRule.Any])))
+    bot.add_rule(_rule(RegexRule(["mail~"])))
+
+    matcher = RuleMatcher(bot.rules)
+    assert matcher.candidates(UserMessage("License  plate")) == []
+    assert matcher.candidates(UserMessage("my license plate")) == [0]
+    assert matcher.candidates(UserMessage("my e-mail")) == [1, 2]
+    assert matcher.candidates(UserMessage("emails")) == [2]
+
+
+@pytest.mark.parametrize("text", [
+    "cat",
+    "cat dog",
+    "a dog and a Cat",
+    "зайчик и лиса",
+    "fox bird cat dog",
+    "concatenate",
+    "the Dog's bird-cat",
+    # Same as ASCII and Cyrillic letters for re.IGNORECASE
+    "BıRD and İ",
+    "ᲁᲂg",
+    "кᲂт",
+    "ſcat",
+    "",
+])
+def test_candidates_keep_matches(text):
+    bot = _bot()
+
+    all_matched = _matched(bot, text, range(len(bot.rules)))
+    candidates = bot.matcher.candidates(UserMessage(text))
+
+    assert _matched(bot, text, candidates) == all_matched
+    assert len(candidates) < len(bot.rules) or not text
+
+
+def test_candidates_keep_matches_fuzz():
+    bot = _bot()
+    rng = random.Random(1)
+    # Letters of words and their variants matched ignoring case
+    alphabet = "catdogfxbirдкоткзайч ıİſ\u1c82\u1c81CATDOGİ"
+
+    for _ in range(200):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+        candidates = bot.matcher.candidates(UserMessage(text))
+        assert _matched(bot, text, candidates) == _matched(bot, text, range(len(bot.rules))), text
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -1,4 +1,5 @@
 import textwrap
+from concurrent.futures import ProcessPoolExecutor
 
 import pytest
 
@@ -92,6 +93,21 @@ def test_rule_parse_many_responses():
     assert rule.flow.commands[0].responses[2] == OutMessageEvent("2")
 
 
+def test_parse_rules_parallel():
+    templates = [
+        {"content": _content("$ cat%d *\n# %d" % (i, i)), "id": "t%d" % i}
+        for i in range(10)
+    ]
+
+    with ProcessPoolExecutor(2) as executor:
+        rules = ArmBotParser.parse_rules(templates, executor=executor, chunk_size=3)
+
+    assert [rule.name for rule in rules] == [template["id"] for template in templates]
+    assert [rule.condition.commands[0].args for rule in rules] == \
+           [[RegexRule.Node("cat%d" % i), RegexRule.Node(RegexRule.Any)] for i in range(10)]
+    assert rules[3].flow.commands[0].responses[0].parts == ["3"]
+
+
 if __name__ == "__main__":
     pytest.main(["-s", "-x", __file__])
 
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+import pytest
+
+from polar.lang import PolarParserError
+from polar.lang.parser_pool import ParserPool, ParserWorker, PolarParserTimeout
+
+FAKE_PARSER = [sys.executable, os.path.join(os.path.dirname(__file__), "fake_polar_parser.py"), "--serve"]
+
+
+@pytest.fixture
+def pool():
+    pool = ParserPool(FAKE_PARSER, size=2, timeout=2)
+    yield pool
+    pool.close()
+
+
+def test_parse(pool):
+    js = pool.parse("$ abc\n# def")
+    assert js["node"] == "flow"
+    assert js["flow"][0]["args"][0]["args"][0]["value"] == "abc"
+
+    assert pool.parse("") is None
+
+
+def test_map_keeps_order(pool):
+    contents = ["$ w%d\n# %d" % (i, i) for i in range(20)]
+    results = pool.map(pool.parse, contents)
+    assert [js["flow"][0]["args"][0]["args"][0]["value"] for js in results] == \
+           ["w%d" % i for i in range(20)]
+
+
+def test_restart_after_crash(pool):
+    with pytest.raises(PolarParserError):
+        pool.parse("crash")
+
+    assert pool.parse("$ abc\n# def") is not None
+
+
+def test_timeout():
+    pool = ParserPool(FAKE_PARSER, size=1, timeout=0.5)
+    try:
+        with pytest.raises(PolarParserTimeout):
+            pool.parse("sleep")
+
+        assert pool.parse("$ abc\n# def") is not None
+    finally:
+        pool.close()
+
+
+def test_write_timeout():
+    # Parser which doesn't read request, big request doesn't fit in pipe
+    worker = ParserWorker([sys.executable, "-c", "import time; time.sleep(60)"])
+    try:
+        started = time.monotonic()
+        with pytest.raises(PolarParserTimeout):
+            worker.call(b"x" * (1 << 22), 0.5)
+        assert time.monotonic() - started < 5
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
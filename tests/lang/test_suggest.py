@@ -0,0 +1,87 @@
+import pytest
+
+from polar.lang import RuleNode
+from polar.lang.all import Flow, Regexp
+from polar.lang.eval import Bot, Rule
+from polar.lang.regex_rule import RegexRule
+
+
+def _rule(*commands, weight=1):
+    return Rule(weight=weight, condition=Flow(list(commands)))
+
+
+def _bot():
+    bot = Bot()
+    bot.add_rules([
+        _rule(RegexRule([RegexRule.Any, "cristmas", RegexRule.Any])),
+        _rule(RuleNode([RegexRule(["merry", "cristmas"])]), weight=2),
+        _rule(RegexRule([["cristal", "crisp~"]])),
+        _rule(RegexRule([RegexRule.Node("cat", weight=3)])),
+        _rule(RegexRule(["c.t"])),
+        _rule(Regexp([r"\bcolou?r\b", r"[abc]+ catalog"])),
+    ])
+    return bot
+
+
+def test_complete():
+    index = _bot().suggest_index
+
+    # Equal weights in alphabetical order
+    assert index.complete("cris") == [("cristmas", 3.), ("crisp", 1.), ("cristal", 1.)]
+    assert index.complete("CRISTM") == [("cristmas", 3.)]
+    assert index.complete("ca", limit=1) == [("cat", 3.)]
+    assert index.complete("c")[:2] == [("cat", 3.), ("cristmas", 3.)]
+    assert index.complete("catalog") == [("catalog", 1.)]
+    assert index.complete("colo") == []
+    assert index.complete("xyz") == []
+    assert index.complete("") == []
+
+
+def test_suggest():
+    index = _bot().suggest_index
+
+    assert index.suggest("merry cri", limit=2) == [("merry cristmas", 3.), ("merry crisp", 1.)]
+    assert index.suggest("merry ") == []
+
+
+def test_rebuilt_with_bot():
+    bot = _bot()
+    index = bot.suggest_index
+    assert bot.suggest_index is index
+
+    bot.add_rule(_rule(RegexRule(["crispy"])))
+    assert bot.suggest_index is not index
+    assert ("crispy", 1.) in bot.suggest_index.complete("crisp")
+
+
+WORDS = ["word%d" % i for i in range(2000)]
+
+
+@pytest.fixture(scope="module")
+def words_index():
+    bot = Bot()
+    bot.add_rules([_rule(RegexRule([word])) for word in WORDS])
+    return bot.suggest_index
+
+
+@pytest.mark.parametrize("prefix, wide", [
+    ("w", True), ("word", True), ("word1", True), ("word19", False), ("word199", False),
+])
+def test_wide_prefix_prepared(monkeypatch, words_index, prefix, wide):
+    # Long slices of wide prefixes are not scanned on request
+    scanned = []
+    top = words_index._top
+
+    def counting_top(start, end, limit):
+        scanned.append(end - start)
+        return top(start, end, limit)
+
+    monkeypatch.setattr(words_index, "_top", counting_top)
+
+    matching = sorted(word for word in WORDS if word.startswith(prefix))
+    assert words_index.complete(prefix) == [(word, 1.) for word in matching[:10]]
+    assert scanned == ([] if wide else [len(matching)])
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from polar.logic.backend import missing_indexes, TEMPLATE_INDEXES, LogicPostgresBackend
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class FakeConnection:
+    """
+    Connection answering every query with given rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+        self.in_transaction = False
+        self.listeners = {}
+        self.termination_listeners = []
+
+    async def fetch(self, query, *args):
+        self.queries.append((query, args))
+        return self.rows
+
+    def transaction(self):
+        connection = self
+
+        class Transaction:
+            async def __aenter__(self):
+                connection.in_transaction = True
+
+            async def __aexit__(self, *exc):
+                connection.in_transaction = False
+
+        return Transaction()
+
+    def cursor(self, query, *args, prefetch):
+        self.queries.append((query, args))
+        assert self.in_transaction
+
+        async def rows():
+            for row in self.rows:
+                yield row
+
+        return rows()
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    async def remove_listener(self, channel, callback):
+        del self.listeners[channel]
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    def remove_termination_listener(self, callback):
+        self.termination_listeners.remove(callback)
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.acquired = 0
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            def __await__(self):
+                return self.__aenter__().__await__()
+
+            async def __aenter__(self):
+                pool.acquired += 1
+                return pool.connection
+
+            async def __aexit__(self, *exc):
+                await pool.release(pool.connection)
+
+        return Acquire()
+
+    async def release(self, connection):
+        self.acquired -= 1
+
+
+def test_missing_indexes():
+    assert missing_indexes({}) == [statement for _, _, statement in TEMPLATE_INDEXES]
+
+    existing = {
+        "suites": [["id"], ["profile_id", "is_enabled"]],
+        "templates": [["id"], ["suite_id"]],
+    }
+    assert missing_indexes(existing) == [
+        "CREATE INDEX templates_suite_id_position_idx ON templates (suite_id, position, id)",
+    ]
+
+    existing["templates"].append(["suite_id", "position", "id", "is_enabled"])
+    assert missing_indexes(existing) == []
+
+
+def test_verify_indexes():
+    connection = FakeConnection([
+        ("suites", ["profile_id"]),
+        ("templates", ["id"]),
+        ("templates", ["suite_id", "position"]),
+    ])
+    pool = FakePool(connection)
+    backend = LogicPostgresBackend(pool)
+
+    assert _run(backend.verify_indexes()) == [
+        "CREATE INDEX templates_suite_id_position_idx ON templates (suite_id, position, id)",
+    ]
+    assert connection.queries[0][1] == (["suites", "templates"],)
+    assert pool.acquired == 0
+
+
+def test_iter_templates():
+    templates = [{"id": "t%d" % i, "content": "$ cat\n# dog"} for i in range(3)]
+    connection = FakeConnection(templates)
+    pool = FakePool(connection)
+    backend = LogicPostgresBackend(pool)
+
+    async def collect():
+        return [template async for template in backend.iter_templates("bot")]
+
+    assert _run(collect()) == templates
+    assert connection.queries == [(LogicPostgresBackend.TEMPLATES_QUERY, ("bot",))]
+    assert not connection.in_transaction
+    assert pool.acquired == 0
+
+
+def test_subscribe_lost():
+    connection = FakeConnection([])
+    pool = FakePool(connection)
+    backend = LogicPostgresBackend(pool, channel="changes")
+    changed, lost = [], []
+
+    async def run():
+        await backend.subscribe(changed.append, lambda: lost.append(True))
+        connection.listeners["changes"](connection, 1, "changes", "bot")
+
+        for listener in connection.termination_listeners:
+            listener(connection)
+        await asyncio.sleep(0)
+        # Nothing to unsubscribe after connection is lost
+        await backend.unsubscribe()
+
+    _run(run())
+    assert changed == ["bot"]
+    assert lost == [True]
+    assert pool.acquired == 0
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,276 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pytest
+
+from polar.lang import OutMessageEvent, UserMessage, AstNode, EvalResult, MatchResult, MatchRange
+from polar.lang.all import SimpleResponse, Flow
+from polar.lang.eval import Bot, Rule, Executor
+from polar.lang.regex_rule import RegexRule
+from tests.logic import execute_event
+
+WORDS = ["cat", "dog", "fox", "owl"]
+
+TEXTS = [
+    "cat",
+    "dog",
+    "cat dog",
+    "a cat and a dog",
+    "owl fox owl",
+    "nothing here",
+    "",
+]
+
+
+class CountingExecutor(Executor):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tested = 0
+
+    async def _test_rule(self, rule, event, context):
+        self.tested += 1
+        return await super()._test_rule(rule, event, context)
+
+
+class SleepCondition(AstNode):
+    """
+    Condition which waits like I/O-backed node and matches whole text
+    """
+    running = 0
+    max_running = 0
+
+    def __init__(self, delay, weight=1):
+        super().__init__()
+        self.delay = delay
+        self.weight = weight
+
+    async def eval(self, event, context, inter):
+        SleepCondition.running += 1
+        SleepCondition.max_running = max(SleepCondition.max_running, SleepCondition.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            SleepCondition.running -= 1
+
+        match = MatchResult()
+        match.ranges.append(MatchRange(0, len(event.text), self.weight))
+        return EvalResult(value=match)
+
+
+class WritingCondition(SleepCondition):
+    """
+    Condition which writes its name to context after delay
+    """
+
+    def __init__(self, delay, name):
+        super().__init__(delay)
+        self.name = name
+
+    async def eval(self, event, context, inter):
+        seen = dict(context)
+        result = await super().eval(event, context, inter)
+        context["last"] = self.name
+        context["seen_" + self.name] = seen
+        return result
+
+
+def _sleep_rule(delay, text, weight=1):
+    return Rule(
+        condition=Flow([SleepCondition(delay, weight)]),
+        flow=Flow([SimpleResponse([OutMessageEvent(text)])]),
+    )
+
+
+def _rule(args, text, weight=None):
+    nodes = [RegexRule.Node(arg, weight=weight) if arg != RegexRule.Any else arg for arg in args]
+    return Rule(
+        condition=Flow([RegexRule(nodes)]),
+        flow=Flow([SimpleResponse([OutMessageEvent(text)])]),
+    )
+
+
+def _results(state):
+    return [(rule_idx, match.ranges) for rule_idx, match in state.sorted_results]
+
+
+def _bot():
+    bot = Bot()
+    bot.add_rule(_rule([RegexRule.Any], "*"))
+    for word in WORDS:
+        bot.add_rule(_rule([word], word))
+        bot.add_rule(_rule([word], word + " heavy", weight=3))
+        bot.add_rule(_rule([RegexRule.Any, word, RegexRule.Any], "* %s *" % word))
+    for w1, w2 in itertools.product(WORDS, WORDS):
+        bot.add_rule(_rule([RegexRule.Any, w1, RegexRule.Any, w2, RegexRule.Any], "%s %s" % (w1, w2)))
+    return bot
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_best_first_same_best(text):
+    bot = _bot()
+
+    events, state = execute_event(UserMessage(text), bot)
+    best_events, best_state = execute_event(UserMessage(text), bot, executor=Executor(best_first=True))
+
+    assert best_events == events
+    assert len(best_state.sorted_results) == 1
+    assert _results(best_state) == _results(state)[:1]
+
+
+def test_best_first_prunes():
+    bot = _bot()
+
+    executor = CountingExecutor()
+    execute_event(UserMessage("cat"), bot, executor=executor)
+    exhaustive = executor.tested
+
+    # Heavy rule is evaluated first, no rule with two words can beat it
+    executor = CountingExecutor(best_first=True)
+    events, _ = execute_event(UserMessage("cat"), bot, executor=executor)
+    assert events[0].parts == ["cat heavy"]
+    assert executor.tested < exhaustive
+
+
+def test_best_first_negative_weight():
+    bot = Bot()
+    bot.add_rule(_rule(["cat"], "cat", weight=-2))
+    # Shorter negative match is better, bound by message length must not prune it
+    bot.add_rule(_rule(["cat and dog"], "cat and dog", weight=-1))
+
+    events, _ = execute_event(UserMessage("cat and dog"), bot)
+    best_events, _ = execute_event(UserMessage("cat and dog"), bot, executor=Executor(best_first=True))
+    assert events[0].parts == ["cat"]
+    assert best_events == events
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("best_first", [False, True])
+@pytest.mark.parametrize("top_k", [1, 3, 100])
+def test_top_k(text, best_first, top_k):
+    bot = _bot()
+
+    _, state = execute_event(UserMessage(text), bot)
+    _, top_state = execute_event(UserMessage(text), bot, executor=Executor(best_first=best_first, top_k=top_k))
+
+    if state is None:
+        assert top_state is None
+    else:
+        assert _results(top_state) == _results(state)[:top_k]
+
+
+def test_best_first_debug_keeps_all():
+    bot = _bot()
+
+    _, state = execute_event(UserMessage("cat dog"), bot)
+    _, debug_state = execute_event(UserMessage("cat dog"), bot,
+                                   executor=Executor(best_first=True, top_k=1, debug=True))
+
+    assert _results(debug_state) == _results(state)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("best_first", [False, True])
+def test_concurrent_same_results(text, best_first):
+    bot = _bot()
+
+    _, state = execute_event(UserMessage(text), bot, executor=Executor(best_first=best_first, top_k=5))
+    _, concurrent_state = execute_event(UserMessage(text), bot,
+                                        executor=Executor(best_first=best_first, top_k=5, concurrency=4))
+
+    if state is None:
+        assert concurrent_state is None
+    else:
+        assert _results(concurrent_state) == _results(state)
+
+
+def test_concurrent_limit():
+    bot = Bot()
+    for i in range(8):
+        bot.add_rule(_sleep_rule(0.1, "r%d" % i))
+
+    SleepCondition.max_running = 0
+    start = time.monotonic()
+    events, state = execute_event(UserMessage("abc"), bot, executor=Executor(concurrency=4))
+    elapsed = time.monotonic() - start
+
+    assert SleepCondition.max_running == 4
+    assert elapsed < 0.6
+    # Equal weights are still resolved by rule order
+    assert events[0].parts == ["r0"]
+    assert [rule_idx for rule_idx, _ in state.sorted_results] == list(range(8))
+
+
+def test_condition_timeout(caplog):
+    bot = Bot()
+    bot.add_rule(_sleep_rule(5, "slow", weight=10))
+    bot.add_rule(_sleep_rule(0, "fast"))
+
+    events, state = execute_event(UserMessage("abc"), bot,
+                                  executor=Executor(concurrency=2, condition_timeout=0.2))
+
+    assert events[0].parts == ["fast"]
+    assert [rule_idx for rule_idx, _ in state.sorted_results] == [1]
+    assert "timed out" in caplog.text
+
+
+def test_concurrent_context_isolated():
+    bot = Bot()
+    # First rule finishes last
+    for name, delay in [("r0", 0.1), ("r1", 0)]:
+        bot.add_rule(Rule(condition=Flow([WritingCondition(delay, name)]),
+                          flow=Flow([SimpleResponse([OutMessageEvent(name)])])))
+
+    context = {"a": 1}
+    execute_event(UserMessage("abc"), bot, context=context, executor=Executor(concurrency=2))
+
+    assert context["last"] == "r1"
+    assert context["seen_r0"] == {"a": 1}
+    assert context["seen_r1"] == {"a": 1}
+
+
+class RecordingPool(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(2)
+        self.threads = set()
+
+    def submit(self, fn, *args, **kwargs):
+        def run():
+            self.threads.add(threading.get_ident())
+            return fn(*args, **kwargs)
+        return super().submit(run)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("best_first", [False, True])
+def test_offloaded_same_results(text, best_first):
+    bot = _bot()
+    # Non-regex condition stays in event loop
+    bot.add_rule(_sleep_rule(0, "sleep", weight=0.5))
+
+    _, state = execute_event(UserMessage(text), bot, executor=Executor(best_first=best_first, top_k=5))
+
+    with RecordingPool() as pool:
+        _, offloaded_state = execute_event(UserMessage(text), bot,
+                                           executor=Executor(best_first=best_first, top_k=5, match_executor=pool))
+        assert pool.threads and threading.get_ident() not in pool.threads
+
+    assert _results(offloaded_state) == _results(state)
+
+
+def test_offloaded_process_pool():
+    bot = _bot()
+
+    events, state = execute_event(UserMessage("a cat and a dog"), bot)
+    with ProcessPoolExecutor(1) as pool:
+        offloaded_events, offloaded_state = execute_event(UserMessage("a cat and a dog"), bot,
+                                                          executor=Executor(match_executor=pool))
+
+    assert offloaded_events == events
+    assert _results(offloaded_state) == _results(state)
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,433 @@
+import asyncio
+import datetime
+import threading
+import time
+
+import pytest
+
+from polar.lang.parser import ArmBotParser
+from polar.logic.backend import LogicBaseBackend
+from polar.lang import UserMessage
+from polar.logic.logic_service import LogicService
+from polar.logic.snapshot import BotSnapshotStore
+
+CREATED = datetime.datetime(2020, 1, 1)
+
+
+class Waiter(list):
+    """
+    List of happened things, which can be waited for
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._added = None
+
+    def add(self, item):
+        self.append(item)
+        if self._added is not None:
+            self._added.set()
+
+    async def wait(self, count, timeout=5.):
+        async def wait():
+            while len(self) < count:
+                self._added = asyncio.Event()
+                await self._added.wait()
+
+        await asyncio.wait_for(wait(), timeout)
+
+
+class MemoryBackend(LogicBaseBackend):
+    def __init__(self):
+        self.templates = {}
+        self.fetches = 0
+        self.version_queries = 0
+        self.polls = Waiter()
+
+    async def get_templates(self, bot_id):
+        self.fetches += 1
+        return list(self.templates.get(bot_id, []))
+
+    async def get_template_versions(self, bot_id):
+        self.version_queries += 1
+        return [
+            {"id": t["id"], "version": t["version"], "created": t["created"]}
+            for t in self.templates.get(bot_id, [])
+        ]
+
+    async def get_change_markers(self, bot_ids):
+        self.polls.add(sorted(bot_ids))
+        # Same as hash of ids and versions in Postgres backend
+        return {
+            bot_id: tuple(sorted((t["id"], t["version"]) for t in self.templates[bot_id]))
+            for bot_id in bot_ids if bot_id in self.templates
+        }
+
+    async def subscribe(self, callback, on_lost=None):
+        self.callback = callback
+        self.on_lost = on_lost
+
+    async def unsubscribe(self):
+        self.callback = None
+
+
+class CountingParser(ArmBotParser):
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+        self.parsed = []
+
+    def load_bot(self, templates, base=None):
+        self.loads += 1
+        return super().load_bot(templates, base=base)
+
+    def parse_rules(self, templates, **kwargs):
+        self.parsed.extend(template["id"] for template in templates)
+        return super().parse_rules(templates, **kwargs)
+
+
+def _template(template_id, content, version=1):
+    return {"id": template_id, "content": content, "version": version, "created": CREATED}
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_cache_hit_and_invalidate():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog")]
+    parser = CountingParser()
+    service = LogicService(backend, parser=parser)
+
+    bot = _run(service.get_bot("bot", 0))
+    assert _run(service.get_bot("bot", 0)) is bot
+    assert parser.loads == 1
+    assert backend.fetches == 1
+
+    backend.templates["bot"] = [_template("t1", "$ cat\n# fox", version=2)]
+    bot2 = _run(service.get_bot("bot", 0))
+    assert bot2 is not bot
+    assert parser.loads == 2
+
+    backend.templates["bot"].append(_template("t2", "$ fox\n# cat"))
+    assert len(_run(service.get_bot("bot", 0)).rules) == 2
+    assert parser.loads == 3
+
+
+def test_incremental_reload():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [
+        _template("t1", "$ cat\n# 1"),
+        _template("t2", "$ dog\n# 2"),
+        _template("t3", "$ fox\n# 3"),
+    ]
+    parser = CountingParser()
+    service = LogicService(backend, parser=parser)
+
+    bot = _run(service.get_bot("bot", 0))
+    assert parser.parsed == ["t1", "t2", "t3"]
+
+    backend.templates["bot"] = [
+        _template("t1", "$ cat\n# 1"),
+        _template("t3", "$ fox\n# 33", version=2),
+        _template("t4", "$ owl\n# 4"),
+    ]
+    parser.parsed = []
+    bot2 = _run(service.get_bot("bot", 0))
+    assert parser.parsed == ["t3", "t4"]
+    assert [rule.name for rule in bot2.rules] == ["t1", "t3", "t4"]
+    assert bot2.rules[0] is bot.rules[0]
+    assert bot2.rules[1].flow.commands[0].responses[0].parts == ["33"]
+
+
+def test_cache_lru_eviction():
+    backend = MemoryBackend()
+    for bot_id in ("a", "b", "c"):
+        backend.templates[bot_id] = [_template(bot_id, "$ *\n# " + bot_id)]
+    parser = CountingParser()
+    service = LogicService(backend, parser=parser, cache_size=2)
+
+    _run(service.get_bot("a", 0))
+    _run(service.get_bot("b", 0))
+    _run(service.get_bot("a", 0))
+    _run(service.get_bot("c", 0))
+    assert parser.loads == 3
+
+    # "b" was least recently used
+    _run(service.get_bot("a", 0))
+    assert parser.loads == 3
+    _run(service.get_bot("b", 0))
+    assert parser.loads == 4
+
+
+def test_snapshot_cold_start(tmp_path):
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog"), _template("t2", "$ *\n# any")]
+    store = BotSnapshotStore(str(tmp_path))
+
+    parser = CountingParser()
+    _run(LogicService(backend, parser=parser, snapshots=store).get_bot("bot", 0))
+    assert parser.loads == 1
+
+    # Fresh process serves bot from snapshot without parsing
+    parser = CountingParser()
+    bot = _run(LogicService(backend, parser=parser, snapshots=store).get_bot("bot", 0))
+    assert parser.loads == 0
+    assert [rule.name for rule in bot.rules] == ["t1", "t2"]
+    assert bot.matcher.candidates(UserMessage("cat")) == [0, 1]
+
+    # Snapshot of other template revision is ignored
+    backend.templates["bot"][0] = _template("t1", "$ cat\n# fox", version=2)
+    parser = CountingParser()
+    bot = _run(LogicService(backend, parser=parser, snapshots=store).get_bot("bot", 0))
+    assert parser.loads == 1
+    assert bot.rules[0].flow.commands[0].responses[0].parts == ["fox"]
+
+
+def test_snapshot_preload(tmp_path):
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog")]
+    _run(LogicService(backend, parser=CountingParser(), snapshots=BotSnapshotStore(str(tmp_path))).get_bot("bot", 0))
+
+    store = BotSnapshotStore(str(tmp_path))
+    assert store.preload() == 1
+
+    # Preloaded bot is served as is, without reading file again
+    for file in tmp_path.iterdir():
+        file.unlink()
+    parser = CountingParser()
+    bot1 = _run(LogicService(backend, parser=parser, snapshots=store).get_bot("bot", 0))
+    bot2 = _run(LogicService(backend, parser=parser, snapshots=store).get_bot("bot", 0))
+    assert parser.loads == 0
+    assert bot1 is bot2
+
+
+class SlowParser(CountingParser):
+    def load_bot(self, templates, base=None):
+        time.sleep(0.2)
+        return super().load_bot(templates, base=base)
+
+
+def test_concurrent_loads_coalesce():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog")]
+    parser = SlowParser()
+    service = LogicService(backend, parser=parser)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        bots = await asyncio.gather(*(service.get_bot("bot", 0) for _ in range(10)))
+        ticker.cancel()
+        return bots, ticks
+
+    bots, ticks = _run(run())
+    assert parser.loads == 1
+    assert backend.fetches == 1
+    assert backend.version_queries == 1
+    assert all(bot is bots[0] for bot in bots)
+    # Event loop is not blocked by compilation
+    assert ticks >= 5
+
+
+class GatedParser(CountingParser):
+    """
+    Compilation waits until gate is open
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def load_bot(self, templates, base=None):
+        self.started.set()
+        self.gate.wait(5)
+        return super().load_bot(templates, base=base)
+
+
+class RefreshRecorder:
+    def __init__(self):
+        self.refreshed = Waiter()
+
+    async def __call__(self, bot_id, version, bot):
+        self.refreshed.add((bot_id, version, bot))
+
+
+async def _refreshed(service):
+    # Refresh tasks are done after listeners are called
+    while service._refreshing:
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize("mode", ["poll", "notify"])
+def test_background_refresh(mode):
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog"), _template("t2", "$ fox\n# owl")]
+    backend.templates["other"] = [_template("t3", "$ owl\n# fox")]
+    parser = CountingParser()
+    service = LogicService(backend, parser=parser)
+    recorder = RefreshRecorder()
+    service.add_refresh_listener(recorder)
+
+    async def run():
+        await service.start_refresh(mode=mode, interval=0.001)
+        bot = await service.get_bot("bot", 0)
+        other = await service.get_bot("other", 0)
+        if mode == "poll":
+            # Both bots are checked after load and nothing changed since
+            await backend.polls.wait(3)
+            await _refreshed(service)
+        assert recorder.refreshed == []
+
+        backend.templates["bot"][1] = _template("t2", "$ fox\n# cat", version=2)
+        if mode == "notify":
+            backend.callback("bot")
+        await recorder.refreshed.wait(1)
+        await _refreshed(service)
+        await service.stop_refresh()
+        return bot, other
+
+    bot, other = _run(run())
+
+    assert len(recorder.refreshed) == 1
+    bot_id, version, new_bot = recorder.refreshed[0]
+    assert (bot_id, version) == ("bot", 0)
+    assert new_bot is not bot
+    # Recompiled incrementally and swapped in cache
+    assert parser.parsed == ["t1", "t2", "t3", "t2"]
+    assert _run(service.get_bot("bot", 0)) is new_bot
+    assert _run(service.get_bot("other", 0)) is other
+
+
+def test_poll_template_swap():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog"), _template("t2", "$ fox\n# owl", version=2)]
+    service = LogicService(backend, parser=CountingParser())
+    recorder = RefreshRecorder()
+    service.add_refresh_listener(recorder)
+
+    async def run():
+        await service.start_refresh(mode="poll", interval=0.001)
+        await service.get_bot("bot", 0)
+        await backend.polls.wait(2)
+        await _refreshed(service)
+
+        # One template disabled and other one with same version enabled:
+        # count and sum of versions are same
+        backend.templates["bot"][1] = _template("t3", "$ fox\n# cat", version=2)
+        await recorder.refreshed.wait(1)
+        await _refreshed(service)
+        await service.stop_refresh()
+
+    _run(run())
+    assert [rule.name for rule in recorder.refreshed[0][2].rules] == ["t1", "t3"]
+
+
+def test_refresh_tracked_evicted():
+    backend = MemoryBackend()
+    backend.templates["a"] = [_template("t1", "$ cat\n# dog"), _template("t2", "$ fox\n# owl")]
+    backend.templates["b"] = [_template("t3", "$ owl\n# fox")]
+    parser = CountingParser()
+    service = LogicService(backend, parser=parser, cache_size=1)
+    recorder = RefreshRecorder()
+    service.add_refresh_listener(recorder)
+
+    bots = {("a", 0): _run(service.get_bot("a", 0)), ("b", 0): _run(service.get_bot("b", 0))}
+    service.track_bots(lambda: bots)
+
+    # "a" is evicted from cache, but still kept by sessions
+    backend.templates["a"][1] = _template("t2", "$ fox\n# cat", version=2)
+    parser.parsed = []
+    _run(service.refresh("a"))
+
+    assert [(bot_id, version) for bot_id, version, _ in recorder.refreshed] == [("a", 0)]
+    # Recompiled from tracked bot
+    assert parser.parsed == ["t2"]
+    assert recorder.refreshed[0][2].rules[0] is bots[("a", 0)].rules[0]
+
+
+def test_poll_tracked_evicted():
+    backend = MemoryBackend()
+    backend.templates["a"] = [_template("t1", "$ cat\n# dog")]
+    backend.templates["b"] = [_template("t2", "$ owl\n# fox")]
+    service = LogicService(backend, parser=CountingParser(), cache_size=1)
+
+    bots = {("a", 0): _run(service.get_bot("a", 0)), ("b", 0): _run(service.get_bot("b", 0))}
+    service.track_bots(lambda: bots)
+
+    async def run():
+        await service.start_refresh(mode="poll", interval=0.001)
+        await backend.polls.wait(1)
+        await service.stop_refresh()
+
+    _run(run())
+    assert backend.polls[0] == ["a", "b"]
+
+
+def test_notify_lost_falls_back_to_polling():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog")]
+    service = LogicService(backend, parser=CountingParser())
+    recorder = RefreshRecorder()
+    service.add_refresh_listener(recorder)
+
+    async def run():
+        await service.start_refresh(mode="notify", interval=0.001)
+        await service.get_bot("bot", 0)
+
+        backend.on_lost()
+        # Change isn't notified anymore
+        backend.templates["bot"] = [_template("t1", "$ cat\n# fox", version=2)]
+        await recorder.refreshed.wait(1)
+        await _refreshed(service)
+        await service.stop_refresh()
+
+    _run(run())
+    assert recorder.refreshed[0][2].rules[0].flow.commands[0].responses[0].parts == ["fox"]
+
+
+def test_change_during_refresh_refreshes_again():
+    backend = MemoryBackend()
+    backend.templates["bot"] = [_template("t1", "$ cat\n# dog")]
+    parser = GatedParser()
+    service = LogicService(backend, parser=parser)
+    recorder = RefreshRecorder()
+    service.add_refresh_listener(recorder)
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        await service.get_bot("bot", 0)
+
+        parser.started.clear()
+        parser.gate.clear()
+        backend.templates["bot"] = [_template("t1", "$ cat\n# fox", version=2)]
+        service.on_bot_changed("bot")
+        await loop.run_in_executor(None, parser.started.wait, 5)
+
+        # Change after revision was read by running refresh
+        backend.templates["bot"] = [_template("t1", "$ cat\n# owl", version=3)]
+        service.on_bot_changed("bot")
+        service.on_bot_changed("bot")
+        parser.gate.set()
+
+        await recorder.refreshed.wait(2)
+        await _refreshed(service)
+
+    _run(run())
+
+    assert len(recorder.refreshed) == 2
+    assert recorder.refreshed[-1][2].rules[0].flow.commands[0].responses[0].parts == ["owl"]
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from polar.lang.eval import Bot, Rule
+from polar.meta.bot_storage import MetaMemoryBotStorageBackend, MetaBotStorage
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_dedup_by_bot_version():
+    storage = MetaBotStorage(MetaMemoryBotStorageBackend())
+    bot = Bot()
+    bot.add_rule(Rule())
+
+    ids = [_run(storage.init("bot", 0, bot)) for _ in range(100)]
+    assert len(set(ids)) == 1
+    assert _run(storage.get(ids[0])) is bot
+    assert _run(storage.init("bot", 1, bot)) != ids[0]
+
+    bot2 = Bot()
+    _run(storage.init("bot", 0, bot2))
+    assert _run(storage.get(ids[0])) is bot2
+
+    assert storage.stats() == {"entries": 2, "rules": 1, "evictions": 0}
+
+
+def test_tracked():
+    storage = MetaBotStorage(MetaMemoryBotStorageBackend())
+    bot, bot2 = Bot(), Bot()
+    _run(storage.init("bot", 0, bot))
+    _run(storage.init("bot", 1, bot2))
+
+    assert storage.tracked() == {("bot", 0): bot, ("bot", 1): bot2}
+
+    expired = MetaBotStorage(MetaMemoryBotStorageBackend(ttl=-1))
+    _run(expired.init("bot", 0, bot))
+    assert expired.tracked() == {}
+
+
+def test_ttl_eviction():
+    storage = MetaBotStorage(MetaMemoryBotStorageBackend(ttl=-1))
+
+    meta_bot_id = _run(storage.init("bot", 0, Bot()))
+    assert _run(storage.get(meta_bot_id)) is None
+
+    _run(storage.init("bot1", 0, Bot()))
+    _run(storage.init("bot2", 0, Bot()))
+    assert storage.stats()["entries"] == 1
+    assert storage.stats()["evictions"] == 2
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
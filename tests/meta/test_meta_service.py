@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from polar.lang import UserMessage, OutMessageEvent
+from polar.lang.all import Flow, SimpleResponse, Set
+from polar.lang.eval import Bot, Rule
+from polar.lang.regex_rule import RegexRule
+from polar.meta.meta_service import MetaService
+from polar.meta.session_storage import MetaSession, MetaSessionStorage, MetaMemorySessionStorageBackend
+from tests.common import LogInteractivity
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class CountingSessionBackend(MetaMemorySessionStorageBackend):
+    def __init__(self):
+        super().__init__()
+        self.updates = 0
+
+    async def update(self, meta_session_id, session):
+        self.updates += 1
+        return await super().update(meta_session_id, session)
+
+
+def _bot():
+    bot = Bot()
+    bot.add_rule(Rule(condition=Flow([RegexRule(["hi"])]),
+                      flow=Flow([SimpleResponse([OutMessageEvent("hello")])])))
+    bot.add_rule(Rule(condition=Flow([RegexRule(["bye"])]),
+                      flow=Flow([SimpleResponse([OutMessageEvent("bye")]), Set("left", "1")])))
+    return bot
+
+
+async def _session(service, bot):
+    session = MetaSession()
+    session.meta_bot_id = await service._bots.init("bot", 0, bot)
+    session.bot_id = "bot"
+    return await service._sessions.init(session)
+
+
+def test_request_without_changes_not_saved():
+    backend = CountingSessionBackend()
+    service = MetaService(db=None, redis=None)
+    service._sessions = MetaSessionStorage(backend)
+    session_id = _run(_session(service, _bot()))
+
+    inter = LogInteractivity()
+    _run(service.push_request(UserMessage("hi"), session_id, inter))
+    assert inter.events[0].parts == ["hello"]
+    # Transient random seed is not a change
+    assert backend.updates == 0
+
+    _run(service.push_request(UserMessage("bye"), session_id, LogInteractivity()))
+    assert backend.updates == 1
+    assert _run(service._sessions.get(session_id)).context == {"left": "1"}
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
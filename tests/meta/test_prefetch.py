@@ -0,0 +1,127 @@
+import asyncio
+import gc
+import weakref
+
+import pytest
+
+from polar.lang import UserMessage
+from polar.lang.eval import Bot, Executor
+from polar.meta.meta_service import MetaService
+from polar.meta.prefetch import MetaPrefetchCache
+from polar.meta.session_storage import MetaSession, MetaSessionStorage, MetaMemorySessionStorageBackend
+from tests.common import LogInteractivity
+from tests.logic import execute_event
+from tests.logic.test_executor import _bot, _results, _sleep_rule
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_reuse_for_same_bot_and_text():
+    cache = MetaPrefetchCache(size=10)
+    bot = _bot()
+    cache.put("s1", "cat", "bot", 0, bot, [1])
+
+    assert cache.get("s1", "cat", "bot", 0, bot) == [1]
+    # Whitespace and case change weights
+    assert cache.get("s1", "Cat", "bot", 0, bot) is None
+    assert cache.get("s1", "cat ", "bot", 0, bot) is None
+    assert cache.get("s2", "cat", "bot", 0, bot) is None
+    assert cache.get("s1", "cat", "bot", 1, bot) is None
+    # Reloaded bot
+    assert cache.get("s1", "cat", "bot", 0, _bot()) is None
+    assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test_bot_not_kept():
+    cache = MetaPrefetchCache(size=10)
+    bot = _bot()
+    cache.put("s", "cat", "bot", 0, bot, [1])
+    ref = weakref.ref(bot)
+
+    del bot
+    gc.collect()
+    assert ref() is None
+    assert cache.get("s", "cat", "bot", 0, _bot()) is None
+
+
+def test_lru():
+    cache = MetaPrefetchCache(size=2)
+    bot = Bot()
+    cache.put("s", "a", "bot", 0, bot, [1])
+    cache.put("s", "b", "bot", 0, bot, [2])
+    cache.get("s", "a", "bot", 0, bot)
+    cache.put("s", "c", "bot", 0, bot, [3])
+
+    assert cache.get("s", "a", "bot", 0, bot) == [1]
+    assert cache.get("s", "b", "bot", 0, bot) is None
+
+
+class CountingRankExecutor(Executor):
+    def __init__(self):
+        super().__init__()
+        self.ranked = 0
+
+    async def rank(self, event, bot, context):
+        self.ranked += 1
+        return await super().rank(event, bot, context)
+
+
+def _service():
+    service = MetaService(db=None, redis=None)
+    service._sessions = MetaSessionStorage(MetaMemorySessionStorageBackend())
+    service._executor = CountingRankExecutor()
+    return service
+
+
+async def _session(service, bot):
+    session = MetaSession()
+    session.meta_bot_id = await service._bots.init("bot", 0, bot)
+    session.bot_id = "bot"
+    return await service._sessions.init(session)
+
+
+def test_service_push_reuses_prefetch():
+    service = _service()
+    session_id = _run(_session(service, _bot()))
+
+    assert _run(service.prefetch(UserMessage("cat"), session_id))
+    inter = LogInteractivity()
+    _run(service.push_request(UserMessage("cat"), session_id, inter))
+
+    assert service._executor.ranked == 1
+    assert inter.events[0].parts == ["cat heavy"]
+
+    # Refreshed bot is ranked again
+    _run(service.prefetch(UserMessage("dog"), session_id))
+    _run(service._on_bot_refresh("bot", 0, _bot()))
+    _run(service.push_request(UserMessage("dog"), session_id, LogInteractivity()))
+    assert service._executor.ranked == 3
+
+
+@pytest.mark.parametrize("text", ["cat", "a cat and a dog", "nothing"])
+def test_ranked_execution_same_as_full(text):
+    bot = _bot()
+    assert bot.matcher.text_only
+
+    events, state = execute_event(UserMessage(text), bot)
+
+    class PrefetchedExecutor(Executor):
+        async def execute_event(self, event, bot, context, inter):
+            sorted_results = await self.rank(event, bot, {})
+            return await self.execute_ranked(sorted_results, event, bot, context, inter)
+
+    prefetched_events, prefetched_state = execute_event(UserMessage(text), bot, executor=PrefetchedExecutor())
+    assert prefetched_events == events
+    assert _results(prefetched_state) == _results(state)
+
+
+def test_not_text_only():
+    bot = _bot()
+    bot.add_rule(_sleep_rule(0, "context"))
+    assert not bot.matcher.text_only
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
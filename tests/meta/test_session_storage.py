@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+from polar.meta.session_storage import MetaSession, MetaSessionStorage, \
+    MetaMemorySessionStorageBackend, MetaCachedSessionStorageBackend
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_json():
+    session = MetaSession()
+    session.meta_bot_id = "bot:0"
+    session.bot_id = "bot"
+    session.context = {"name": "Саша"}
+    session.version = 3
+
+    loaded = MetaSession.from_json(session.to_json())
+    assert loaded.__dict__ == session.__dict__
+
+
+def test_update_context():
+    storage = MetaSessionStorage(MetaMemorySessionStorageBackend())
+    session = MetaSession()
+    session.context = {"a": 1, "b": 2}
+    session_id = _run(storage.init(session))
+
+    loaded = _run(storage.get(session_id))
+    updated = _run(storage.update_context(session_id, loaded, {"c": 3}, ["a"]))
+    assert updated.context == {"b": 2, "c": 3}
+    assert updated.version == 1
+    assert loaded.context == {"a": 1, "b": 2}
+    assert _run(storage.get(session_id)).context == {"b": 2, "c": 3}
+
+
+def test_update_context_concurrent():
+    storage = MetaSessionStorage(MetaMemorySessionStorageBackend())
+    session_id = _run(storage.init(MetaSession()))
+
+    # Both requests loaded same session version
+    first = _run(storage.get(session_id))
+    second = _run(storage.get(session_id))
+
+    _run(storage.update_context(session_id, first, {"a": 1}))
+    updated = _run(storage.update_context(session_id, second, {"b": 2}))
+
+    assert updated.context == {"a": 1, "b": 2}
+    assert updated.version == 2
+    assert _run(storage.get(session_id)).context == {"a": 1, "b": 2}
+
+
+def test_update_context_gone():
+    backend = MetaMemorySessionStorageBackend()
+    storage = MetaSessionStorage(backend)
+    session_id = _run(storage.init(MetaSession()))
+    loaded = _run(storage.get(session_id))
+
+    backend.sessions.clear()
+    assert _run(storage.update_context(session_id, loaded, {"a": 1})) is None
+    assert _run(storage.get(session_id)) is None
+
+
+def test_memory_lru_bound():
+    backend = MetaMemorySessionStorageBackend(max_size=2)
+    first = _run(backend.init(MetaSession()))
+    second = _run(backend.init(MetaSession()))
+
+    assert _run(backend.get(first)) is not None
+    _run(backend.init(MetaSession()))
+
+    assert _run(backend.get(second)) is None
+    assert _run(backend.get(first)) is not None
+    assert len(backend.sessions) == 2
+    assert backend.evictions == 1
+
+
+def test_memory_ttl():
+    backend = MetaMemorySessionStorageBackend(ttl=0.05)
+    session_id = _run(backend.init(MetaSession()))
+
+    # Every access prolongs session
+    for _ in range(4):
+        _run(asyncio.sleep(0.03))
+        assert _run(backend.get(session_id)) is not None
+
+    _run(asyncio.sleep(0.06))
+    assert _run(backend.get(session_id)) is None
+    assert backend.evictions == 1
+
+
+def test_memory_ttl_update_expired():
+    backend = MetaMemorySessionStorageBackend(ttl=0.05)
+    storage = MetaSessionStorage(backend)
+    session_id = _run(storage.init(MetaSession()))
+    loaded = _run(storage.get(session_id))
+
+    _run(asyncio.sleep(0.06))
+    assert _run(storage.update_context(session_id, loaded, {"a": 1})) is None
+    assert _run(storage.get(session_id)) is None
+    assert backend.evictions == 1
+
+
+def test_cached_backend():
+    remote = MetaMemorySessionStorageBackend()
+    # Two processes with own local caches and shared remote storage
+    cached1 = MetaCachedSessionStorageBackend(remote)
+    cached2 = MetaCachedSessionStorageBackend(remote)
+    storage1, storage2 = MetaSessionStorage(cached1), MetaSessionStorage(cached2)
+
+    session_id = _run(storage1.init(MetaSession()))
+    _run(storage1.get(session_id))
+    assert (cached1.hits, cached1.misses) == (1, 0)
+
+    _run(storage2.update_context(session_id, _run(storage2.get(session_id)), {"a": 1}))
+
+    # Stale local copy is detected on write and changes are merged
+    updated = _run(storage1.update_context(session_id, _run(storage1.get(session_id)), {"b": 2}))
+    assert updated.context == {"a": 1, "b": 2}
+    assert _run(storage1.get(session_id)).context == {"a": 1, "b": 2}
+    assert _run(remote.get(session_id)).context == {"a": 1, "b": 2}
+
+
+def test_cached_backend_gone():
+    remote = MetaMemorySessionStorageBackend()
+    cached = MetaCachedSessionStorageBackend(remote)
+    storage = MetaSessionStorage(cached)
+    session_id = _run(storage.init(MetaSession()))
+    loaded = _run(storage.get(session_id))
+
+    # Expired remotely while local copy is fresh
+    remote.sessions.clear()
+    assert _run(storage.update_context(session_id, loaded, {"a": 1})) is None
+    assert _run(remote.get(session_id)) is None
+    assert _run(storage.get(session_id)) is None
+
+
+def test_cached_backend_refresh():
+    remote = MetaMemorySessionStorageBackend()
+    cached = MetaCachedSessionStorageBackend(remote, refresh=0)
+
+    session_id = _run(cached.init(MetaSession()))
+    _run(cached.get(session_id))
+    _run(cached.get(session_id))
+    assert (cached.hits, cached.misses) == (0, 2)
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
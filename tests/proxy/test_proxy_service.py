@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from aiohttp import WSCloseCode
+from aiohttp.test_utils import TestClient, TestServer
+
+from polar.lang import OutMessageEvent
+from polar.proxy import proxy_conf, proxy_service
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class SlowMeta:
+    """
+    Replies with request text after delay
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def init_session(self, bot_id):
+        return "session"
+
+    async def push_request(self, event, session_id, inter):
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        await inter.send_event(OutMessageEvent(event.text))
+
+
+class FailingMeta(SlowMeta):
+    async def push_request(self, event, session_id, inter):
+        raise RuntimeError("fail")
+
+
+def _app(meta):
+    app = proxy_service.create_app()
+    # No database and redis
+    app.on_startup.remove(proxy_service.on_startup)
+    app.on_cleanup.remove(proxy_service.on_cleanup)
+    app["meta"] = meta
+    return app
+
+
+async def _shutdown_during_request(meta):
+    app = _app(meta)
+    async with TestClient(TestServer(app)) as client:
+        ws = await client.ws_connect("/ws")
+        await ws.send_json({"type": "hello", "bot_id": "bot", "request_id": "1"})
+        await ws.send_json({"type": "text", "text": "slow", "request_id": "2"})
+        await meta.started.wait()
+
+        shutdown = asyncio.ensure_future(app.shutdown())
+        while not app["stopping"].is_set():
+            await asyncio.sleep(0)
+        await ws.send_json({"type": "text", "text": "late", "request_id": "3"})
+
+        messages = []
+        async for msg in ws:
+            messages.append(msg.json())
+        await shutdown
+        return messages, ws.close_code
+
+
+def test_shutdown_finishes_open_requests():
+    messages, close_code = _run(_shutdown_during_request(SlowMeta(0.1)))
+
+    assert messages == [
+        {"type": "error", "text": "Server shutdown", "code": 13, "request_id": "3"},
+        {"type": "text", "text": "slow", "request_id": "2"},
+    ]
+    assert close_code == WSCloseCode.GOING_AWAY
+
+
+def test_shutdown_drain_timeout(monkeypatch):
+    monkeypatch.setattr(proxy_conf, "PROXY_DRAIN_TIMEOUT", 0.1)
+
+    messages, close_code = _run(_shutdown_during_request(SlowMeta(5)))
+
+    assert [msg["request_id"] for msg in messages] == ["3"]
+    assert close_code == WSCloseCode.GOING_AWAY
+
+
+def test_failed_request_replied():
+    async def run():
+        async with TestClient(TestServer(_app(FailingMeta(0)))) as client:
+            ws = await client.ws_connect("/ws")
+            await ws.send_json({"type": "hello", "bot_id": "bot", "request_id": "1"})
+            await ws.send_json({"type": "text", "text": "hi", "request_id": "2"})
+            message = await ws.receive_json(timeout=1)
+            await ws.close()
+            return message
+
+    assert _run(run()) == {"type": "error", "text": "Request failed", "code": 14, "request_id": "2"}
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
@@ -0,0 +1,102 @@
+import os
+import signal
+
+import pytest
+
+from polar.proxy import supervisor
+from polar.proxy.supervisor import Supervisor
+
+
+class FakeOs:
+    """
+    Process calls of supervisor, forked workers exit only when told to
+    """
+    WNOHANG = os.WNOHANG
+
+    def __init__(self):
+        self.last_pid = 100
+        self.alive = set()
+        self.exited = []
+        self.killed = []
+
+    def fork(self):
+        self.last_pid += 1
+        self.alive.add(self.last_pid)
+        return self.last_pid
+
+    def kill(self, pid, signo):
+        self.killed.append((pid, signo))
+        self.exit(pid)
+
+    def exit(self, pid, status=0):
+        self.alive.discard(pid)
+        self.exited.append((pid, status))
+
+    def waitpid(self, pid, options):
+        if self.exited:
+            return self.exited.pop(0)
+        if not self.alive:
+            raise ChildProcessError()
+        return 0, 0
+
+
+class SignalInfo:
+    def __init__(self, signo):
+        self.si_signo = signo
+
+
+@pytest.fixture
+def fake_os(monkeypatch):
+    fake = FakeOs()
+    monkeypatch.setattr(supervisor, "os", fake)
+    monkeypatch.setattr(Supervisor, "RESTART_DELAY", 0)
+    return fake
+
+
+def _supervisor(workers):
+    sup = Supervisor(lambda: None, workers)
+    sup._mask = set()
+    for _ in range(workers):
+        sup._spawn()
+    return sup
+
+
+def test_spawn(fake_os):
+    sup = _supervisor(2)
+    assert set(sup._workers) == fake_os.alive == {101, 102}
+
+
+def test_crashed_restarted(fake_os):
+    sup = _supervisor(2)
+
+    fake_os.exit(101, status=256)
+    sup._reap()
+
+    assert set(sup._workers) == fake_os.alive == {102, 103}
+
+
+def test_restart(fake_os):
+    sup = _supervisor(2)
+
+    sup._on_signal(signal.SIGHUP)
+    # New workers are started before old ones are stopped
+    assert set(sup._workers) == {103, 104}
+    assert fake_os.killed == [(101, signal.SIGTERM), (102, signal.SIGTERM)]
+
+    sup._reap()
+    assert set(sup._workers) == fake_os.alive == {103, 104}
+    assert not sup._retiring
+
+
+def test_run_stops(fake_os, monkeypatch):
+    signals = [None, SignalInfo(signal.SIGHUP), SignalInfo(signal.SIGTERM)]
+    monkeypatch.setattr(signal, "sigtimedwait", lambda sigset, timeout: signals.pop(0) if signals else None)
+
+    Supervisor(lambda: None, 2).run()
+
+    assert not fake_os.alive
+    assert [pid for pid, _ in fake_os.killed] == [101, 102, 103, 104]
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])
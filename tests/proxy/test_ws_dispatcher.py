@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from polar.proxy.ws_dispatcher import WsDispatcher, Ordering
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class Recorder:
+    def __init__(self):
+        self.log = []
+        self.running = 0
+        self.max_running = 0
+
+    def handler(self, request_id, delay):
+        async def handle():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.log.append(("start", request_id))
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.running -= 1
+            self.log.append(("done", request_id))
+        return handle
+
+    async def dispatch(self, dispatcher, request_type, request_id, delay):
+        js = {"type": request_type, "request_id": request_id}
+        return await dispatcher.dispatch(js, self.handler(request_id, delay))
+
+
+def test_text_ordered_others_overlap():
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher(ordering=Ordering.TEXT)
+        await recorder.dispatch(dispatcher, "text", "t1", 0.1)
+        await recorder.dispatch(dispatcher, "text", "t2", 0)
+        await recorder.dispatch(dispatcher, "suggest", "s1", 0)
+        await dispatcher.join()
+        return recorder.log
+
+    log = _run(run())
+    # Suggest is done before slow text, next text waits for it
+    assert log.index(("done", "s1")) < log.index(("done", "t1"))
+    assert log.index(("done", "t1")) < log.index(("start", "t2"))
+
+
+def test_strict_ordering():
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher(ordering=Ordering.STRICT)
+        await recorder.dispatch(dispatcher, "text", "t1", 0.05)
+        await recorder.dispatch(dispatcher, "suggest", "s1", 0)
+        await recorder.dispatch(dispatcher, "text", "t2", 0)
+        await dispatcher.join()
+        return recorder.log
+
+    assert _run(run()) == [("start", "t1"), ("done", "t1"),
+                           ("start", "s1"), ("done", "s1"),
+                           ("start", "t2"), ("done", "t2")]
+
+
+def test_newer_prefetch_cancels_stale():
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher()
+        first = await recorder.dispatch(dispatcher, "prefetch", "p1", 1)
+        await asyncio.sleep(0)
+        await recorder.dispatch(dispatcher, "prefetch", "p2", 0)
+        await dispatcher.join()
+        return recorder.log, first
+
+    log, first = _run(run())
+    assert first.cancelled()
+    assert ("done", "p1") not in log
+    assert ("done", "p2") in log
+
+
+def test_window():
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher(window=3, ordering=Ordering.NONE)
+        for i in range(10):
+            await recorder.dispatch(dispatcher, "text", "t%d" % i, 0.01)
+        await dispatcher.join()
+        return recorder
+
+    recorder = _run(run())
+    assert recorder.max_running == 3
+    assert len([entry for entry in recorder.log if entry[0] == "done"]) == 10
+
+
+def test_failed_request_doesnt_break_chain():
+    async def fail():
+        raise RuntimeError("fail")
+
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher()
+        await dispatcher.dispatch({"type": "text", "request_id": "t1"}, fail)
+        await recorder.dispatch(dispatcher, "text", "t2", 0)
+        await dispatcher.join()
+        return recorder.log
+
+    assert _run(run()) == [("start", "t2"), ("done", "t2")]
+
+
+def test_close_cancels():
+    async def run():
+        recorder = Recorder()
+        dispatcher = WsDispatcher()
+        task = await recorder.dispatch(dispatcher, "text", "t1", 10)
+        await dispatcher.close()
+        return task
+
+    assert _run(run()).cancelled()
+
+
+if __name__ == "__main__":
+    pytest.main(["-s", "-x", __file__])